@@ -0,0 +1,456 @@
+#!/usr/bin/env python3
+"""
+Benchmarks FileSync.main against a local FTP server and a throwaway Postgres.
+
+    python benchmark.py --files 500 --output benchmark_report.json
+    python benchmark.py --dsn 'dbname=bench' --scenario cold --compare benchmark_report.json
+
+Needs pyftpdlib (requirements-bench.txt) and either --dsn of a scratch database,
+whose item, file and docass tables are dropped and recreated, or the PostgreSQL
+server binaries (initdb, pg_ctl) on PATH.
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from contextlib import ExitStack
+
+import psycopg2
+import psycopg2.extensions
+from psycopg2.extras import execute_values
+
+import ftp_db_sync
+
+BENCH_USER = 'bench'
+BENCH_PASSWD = 'bench'
+BENCH_FTP_DIR = 'FTP'
+
+SCHEMA_SQL = """
+    DROP TABLE IF EXISTS docass, file, item, file_dedup_state;
+    DROP SEQUENCE IF EXISTS file_changed_seq;
+    CREATE TABLE item (
+        item_id serial PRIMARY KEY,
+        item_number text NOT NULL UNIQUE);
+    CREATE TABLE file (
+        file_id serial PRIMARY KEY,
+        file_title text NOT NULL,
+        file_stream bytea,
+        file_descrip text);
+    CREATE TABLE docass (
+        docass_id serial PRIMARY KEY,
+        docass_source_id integer NOT NULL,
+        docass_source_type text NOT NULL,
+        docass_target_id integer NOT NULL,
+        docass_target_type text NOT NULL,
+        docass_purpose char(1) NOT NULL,
+        docass_created timestamptz);
+"""
+MIGRATION_PATHS = [
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), name)
+    for name in ['file_title_item_number_index.sql', 'file_content_hash.sql']]
+
+# updated: share of items that have an older revision stored in the database
+# new: share of items that are on FTP, but have no file in the database yet
+# convert: share of FTP files that are not PDF, and go through lowriter
+# warmup: runs before the measured one, on the same FTP directory, database and manifest
+Scenario = namedtuple('Scenario', ['name', 'updated', 'new', 'convert', 'warmup', 'full_sync'])
+
+SCENARIOS = [
+    Scenario('cold', 0.0, 1.0, 0.0, 0, True),
+    Scenario('noop-resync', 0.0, 1.0, 0.0, 1, False),
+    Scenario('mostly-updates', 0.9, 0.1, 0.0, 0, True),
+    Scenario('mostly-new', 0.1, 0.9, 0.0, 0, True),
+    Scenario('conversion-heavy', 0.2, 0.8, 0.8, 0, True),
+]
+
+
+class CountingCursor(psycopg2.extensions.cursor):
+    """
+    Counts every statement sent to the server, as one round-trip each
+    """
+    lock = threading.Lock()
+    round_trips = 0
+
+    @classmethod
+    def count(cls):
+        with cls.lock:
+            cls.round_trips += 1
+
+    def execute(self, *args, **kwargs):
+        self.count()
+        return super().execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        self.count()
+        return super().executemany(*args, **kwargs)
+
+    def copy_expert(self, *args, **kwargs):
+        self.count()
+        return super().copy_expert(*args, **kwargs)
+
+
+class CountingConnection(psycopg2.extensions.connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cursor_factory = CountingCursor
+
+
+class LocalPostgres(object):
+    """
+    A throwaway cluster in a temporary directory, listening on a unix socket only
+    """
+
+    def __init__(self, directory):
+        self.data_dir = os.path.join(directory, 'pgdata')
+        self.socket_dir = directory
+        self.port = free_port()
+
+    @property
+    def dsn(self):
+        return 'host={} port={} user=postgres dbname=postgres'.format(self.socket_dir, self.port)
+
+    def __enter__(self):
+        subprocess.run(
+            ['initdb', '-D', self.data_dir, '-U', 'postgres', '--auth=trust', '--no-sync'],
+            check=True, stdout=subprocess.DEVNULL)
+        subprocess.run(
+            ['pg_ctl', '-D', self.data_dir, '-w', '-l', os.path.join(self.socket_dir, 'postgres.log'),
+             '-o', "-p {} -k {} -c listen_addresses='' -c fsync=off".format(self.port, self.socket_dir),
+             'start'],
+            check=True, stdout=subprocess.DEVNULL)
+        return self
+
+    def __exit__(self, *exc):
+        subprocess.run(
+            ['pg_ctl', '-D', self.data_dir, '-w', '-m', 'fast', 'stop'],
+            check=False, stdout=subprocess.DEVNULL)
+
+
+class LocalFTP(object):
+    """
+    pyftpdlib server on a random localhost port, serving root read only
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.server = None
+        self.thread = None
+
+    def __enter__(self):
+        from pyftpdlib.authorizers import DummyAuthorizer
+        from pyftpdlib.handlers import FTPHandler
+        from pyftpdlib.servers import ThreadedFTPServer
+
+        authorizer = DummyAuthorizer()
+        authorizer.add_user(BENCH_USER, BENCH_PASSWD, self.root, perm='elr')
+        handler = type('BenchHandler', (FTPHandler,), {'authorizer': authorizer, 'banner': 'benchmark'})
+        logging.getLogger('pyftpdlib').setLevel(logging.WARNING)
+        self.server = ThreadedFTPServer(('127.0.0.1', 0), handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, kwargs={'timeout': 0.5}, daemon=True)
+        self.thread.start()
+        return self
+
+    @property
+    def port(self):
+        return self.server.address[1]
+
+    def __exit__(self, *exc):
+        self.server.close_all()
+        self.thread.join(timeout=5)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def file_sizes(count, median_kb, sigma, rng):
+    """
+    Log-normal file sizes, most files small and a long tail of big ones
+    """
+    return [max(int(rng.lognormvariate(0, sigma) * median_kb * 1024), 64) for _ in range(count)]
+
+
+def file_content(extension, size, rng):
+    if extension == '.pdf':
+        header = b'%PDF-1.4\n'
+        return header + rng.getrandbits(8 * (size - len(header))).to_bytes(size - len(header), 'little')
+    line = b'benchmark document line\n'
+    return (line * (size // len(line) + 1))[:size]
+
+
+def seed(dsn, ftp_root, scenario, options):
+    """
+    Recreate the schema and the FTP directory for a scenario, returns the expected counts
+    """
+    rng = random.Random(options.seed)
+    sizes = file_sizes(options.files, options.median_kb, options.sigma, rng)
+    ftp_dir = os.path.join(ftp_root, BENCH_FTP_DIR)
+    shutil.rmtree(ftp_dir, ignore_errors=True)
+    os.makedirs(ftp_dir)
+
+    items, stored, ftp_files = [], [], 0
+    for index, size in enumerate(sizes):
+        item_number = 'BENCH{:06d}'.format(index)
+        items.append((item_number,))
+        kind = rng.random()
+        if kind < scenario.updated:
+            stored.append((item_number, '{}_1 stored revision.pdf'.format(item_number)))
+        elif kind >= scenario.updated + scenario.new:
+            # unchanged, the stored revision is the one on FTP
+            stored.append((item_number, '{}_2 benchmark document.pdf'.format(item_number)))
+        extension = '.txt' if rng.random() < scenario.convert else '.pdf'
+        file_name = '{}_2 benchmark document{}'.format(item_number, extension)
+        with open(os.path.join(ftp_dir, file_name), 'wb') as ftp_file:
+            ftp_file.write(file_content(extension, size, rng))
+        ftp_files += 1
+        if rng.random() < options.old_revisions:
+            # an older revision left on FTP, skipped by the sync
+            with open(os.path.join(ftp_dir, '{}_1 old revision.pdf'.format(item_number)), 'wb') as ftp_file:
+                ftp_file.write(file_content('.pdf', 64, rng))
+            ftp_files += 1
+
+    with psycopg2.connect(dsn) as conn, conn.cursor() as cursor:
+        cursor.execute(SCHEMA_SQL)
+        execute_values(cursor, 'INSERT INTO item (item_number) VALUES %s', items, page_size=1000)
+        execute_values(cursor, """
+            WITH stored (item_number, title) AS (VALUES %s),
+            inserted AS (
+                INSERT INTO file (file_title, file_stream, file_descrip)
+                SELECT title, '\\x00'::bytea, 'stored' FROM stored
+                RETURNING file_id, file_title)
+            INSERT INTO docass (docass_source_id, docass_source_type, docass_target_id,
+                                docass_target_type, docass_purpose, docass_created)
+            SELECT item.item_id, 'I', inserted.file_id, 'FILE', 'S', now()
+            FROM inserted
+            JOIN item ON item.item_number = split_part(inserted.file_title, '_', 1);
+        """, stored, page_size=1000)
+    conn.close()
+
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction, nor in a multi-statement query
+    conn = psycopg2.connect(dsn)
+    conn.autocommit = True
+    with conn.cursor() as cursor:
+        for path in MIGRATION_PATHS:
+            with open(path) as migration:
+                statements = migration.read().split(';')
+            for statement in statements:
+                lines = [line for line in statement.splitlines() if not line.lstrip().startswith('--')]
+                if ''.join(lines).strip():
+                    cursor.execute('\n'.join(lines))
+    conn.close()
+    return {'ftp_files': ftp_files, 'items': len(items), 'stored_files': len(stored), 'bytes': sum(sizes)}
+
+
+def instrument_phases(phases):
+    """
+    Wrap the FileSync steps, adding the time spent in each of them to phases
+    """
+    def timed(name, method):
+        def wrapper(*args, **kwargs):
+            started = time.monotonic()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                phases[name] = phases.get(name, 0.0) + time.monotonic() - started
+        return wrapper
+
+    for name in ['cleanup', 'get_ftp_file_names', 'filter_unchanged_files', 'match_db_items',
+                 'filter_ftp_items_already_stored', 'files_to_be_updated', 'process_files',
+                 'close_db']:
+        setattr(ftp_db_sync.FileSync, name, timed(name, getattr(ftp_db_sync.FileSync, name)))
+
+
+def instrument_stages(stages):
+    """
+    Keep the per stage counters of every pipeline run
+    """
+    report = ftp_db_sync.Pipeline.report
+
+    def wrapper(pipeline, elapsed):
+        for stage in pipeline.stages:
+            stages[stage.name] = {
+                'items': stage.items, 'bytes': stage.bytes, 'busy': round(stage.busy, 4),
+                'workers': stage.workers}
+        return report(pipeline, elapsed)
+    ftp_db_sync.Pipeline.report = wrapper
+
+
+def run_sync(settings, results):
+    """
+    One FileSync.main run, in its own process so that peak RSS is measured per run
+    """
+    ftp_db_sync.FTP_HOST = '127.0.0.1'
+    ftp_db_sync.FTP_PORT = settings['ftp_port']
+    ftp_db_sync.FTP_USER = BENCH_USER
+    ftp_db_sync.FTP_PASSWD = BENCH_PASSWD
+    ftp_db_sync.FTP_DIR = BENCH_FTP_DIR
+    ftp_db_sync.TEMP_DIR = os.path.join(settings['work_dir'], 'temp_files')
+    ftp_db_sync.conn_config = {'dsn': settings['dsn'], 'connection_factory': CountingConnection}
+    logging.getLogger().setLevel(settings['log_level'])
+
+    phases, stages = {}, {}
+    instrument_phases(phases)
+    instrument_stages(stages)
+    process = ftp_db_sync.FileSync(
+        download_workers=settings['download_workers'],
+        ftp_connections=settings['ftp_connections'],
+        convert_workers=settings['convert_workers'],
+        cache_dir=settings['cache_dir'],
+        manifest_path=os.path.join(settings['work_dir'], 'ftp_manifest.json'),
+        full_sync=settings['full_sync'],
+        db_connections=settings['db_connections'])
+    started = time.monotonic()
+    process.main()
+    wall = time.monotonic() - started
+    results.put({
+        'wall': round(wall, 4),
+        'phases': {name: round(elapsed, 4) for name, elapsed in phases.items()},
+        'stages': stages,
+        # kilobytes on Linux
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'db_round_trips': CountingCursor.round_trips,
+        'failed_files': len(process.failed_files),
+    })
+
+
+def run_in_child(settings):
+    context = multiprocessing.get_context('fork')
+    results = context.Queue()
+    child = context.Process(target=run_sync, args=(settings, results))
+    child.start()
+    child.join()
+    if child.exitcode != 0:
+        raise RuntimeError('benchmark run failed with exit code {}'.format(child.exitcode))
+    return results.get(timeout=5)
+
+
+def database_counts(dsn):
+    with psycopg2.connect(dsn) as conn, conn.cursor() as cursor:
+        cursor.execute('SELECT (SELECT count(*) FROM file), (SELECT count(*) FROM docass);')
+        files, links = cursor.fetchone()
+    conn.close()
+    return {'files': files, 'docass': links}
+
+
+def run_scenario(scenario, dsn, options):
+    with tempfile.TemporaryDirectory(prefix='ftp_bench_') as work_dir:
+        ftp_root = os.path.join(work_dir, 'ftp')
+        os.makedirs(os.path.join(work_dir, 'temp_files'))
+        dataset = seed(dsn, ftp_root, scenario, options)
+        with LocalFTP(ftp_root) as ftp:
+            settings = {
+                'ftp_port': ftp.port,
+                'dsn': dsn,
+                'work_dir': work_dir,
+                'cache_dir': os.path.join(work_dir, 'conversion_cache') if options.cache else None,
+                'full_sync': scenario.full_sync,
+                'download_workers': options.download_workers,
+                'ftp_connections': options.ftp_connections,
+                'convert_workers': options.convert_workers,
+                'db_connections': options.db_connections,
+                'log_level': options.log_level,
+            }
+            for _ in range(scenario.warmup):
+                run_in_child(settings)
+            runs = [run_in_child(settings) for _ in range(options.repeat)]
+        measured = min(runs, key=lambda run: run['wall'])
+    logging.info('{}: {:.2f}s, {} round-trips, {} KB peak RSS'.format(
+        scenario.name, measured['wall'], measured['db_round_trips'], measured['peak_rss_kb']))
+    return dict(measured, dataset=dataset, database=database_counts(dsn),
+                walls=[run['wall'] for run in runs], scenario=scenario._asdict())
+
+
+def compare(report, baseline, threshold):
+    """
+    Print the change against a previous report, returns the scenarios slower than threshold percent
+    """
+    regressions = []
+    for name, result in report['scenarios'].items():
+        previous = baseline['scenarios'].get(name)
+        if previous is None:
+            continue
+        for metric in ['wall', 'peak_rss_kb', 'db_round_trips']:
+            change = 100.0 * (result[metric] - previous[metric]) / max(previous[metric], 1e-6)
+            print('{:<18} {:<15} {:>12} -> {:>12} {:+7.1f}%'.format(
+                name, metric, previous[metric], result[metric], change))
+            if metric == 'wall' and threshold is not None and change > threshold:
+                regressions.append(name)
+    return regressions
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='Benchmark FileSync against local FTP and Postgres')
+    parser.add_argument('--dsn', help='scratch database, by default a temporary cluster is started')
+    parser.add_argument(
+        '--scenario', action='append', choices=[scenario.name for scenario in SCENARIOS],
+        help='scenario to run, can be repeated, by default all of them')
+    parser.add_argument('--files', type=int, default=200, help='items and FTP files per scenario')
+    parser.add_argument('--median-kb', type=float, default=200, help='median file size')
+    parser.add_argument('--sigma', type=float, default=1.0, help='spread of the log-normal file sizes')
+    parser.add_argument(
+        '--old-revisions', type=float, default=0.3,
+        help='share of items that also have an older revision on FTP')
+    parser.add_argument('--seed', type=int, default=1, help='seed of the synthetic data')
+    parser.add_argument('--repeat', type=int, default=1, help='measured runs per scenario, the fastest is kept')
+    parser.add_argument('--download-workers', type=int, default=ftp_db_sync.DOWNLOAD_WORKERS)
+    parser.add_argument('--ftp-connections', type=int, default=ftp_db_sync.FTP_POOL_SIZE)
+    parser.add_argument('--convert-workers', type=int, default=ftp_db_sync.CONVERT_WORKERS)
+    parser.add_argument('--db-connections', type=int, default=ftp_db_sync.DB_POOL_SIZE)
+    parser.add_argument('--no-cache', dest='cache', action='store_false', help='disable the conversion cache')
+    parser.add_argument('--output', default='benchmark_report.json', help='JSON report written after the run')
+    parser.add_argument('--compare', help='previous JSON report to compare with')
+    parser.add_argument(
+        '--fail-above', type=float,
+        help='exit with status 1 if a scenario got slower than this many percent')
+    parser.add_argument('--log-level', default='WARNING', help='log level of the sync runs')
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    options = parse_args(args)
+    scenarios = [scenario for scenario in SCENARIOS if not options.scenario or scenario.name in options.scenario]
+    if any(scenario.convert for scenario in scenarios) and shutil.which('lowriter') is None:
+        logging.warning('lowriter not found, conversions will fail and be counted in failed_files')
+
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': sys.version.split()[0],
+        'options': {key: value for key, value in vars(options).items() if key not in ('dsn', 'output', 'compare')},
+        'scenarios': {},
+    }
+    with ExitStack() as stack:
+        dsn = options.dsn
+        if dsn is None:
+            pg_dir = stack.enter_context(tempfile.TemporaryDirectory(prefix='ftp_bench_pg_'))
+            dsn = stack.enter_context(LocalPostgres(pg_dir)).dsn
+        for scenario in scenarios:
+            report['scenarios'][scenario.name] = run_scenario(scenario, dsn, options)
+
+    with open(options.output, 'w') as output:
+        json.dump(report, output, indent=2)
+    logging.info('Report written to {}'.format(options.output))
+
+    if options.compare:
+        with open(options.compare) as baseline:
+            regressions = compare(report, json.load(baseline), options.fail_above)
+        if regressions:
+            logging.error('Slower than {}%: {}'.format(options.fail_above, ', '.join(regressions)))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
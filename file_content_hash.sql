@@ -0,0 +1,27 @@
+-- Content hashes and change numbers maintained by ftp_db_sync.py, needs PostgreSQL 11+ for sha256().
+-- file_sha256 lets the sync skip writing content that is already stored for an item,
+-- file_changed lets `ftp_db_sync.py --dedup` only check files changed since its last run.
+-- Run once before deploying the sync script, after file_title_item_number_index.sql.
+CREATE SEQUENCE IF NOT EXISTS file_changed_seq;
+
+ALTER TABLE file
+    ADD COLUMN IF NOT EXISTS file_sha256 bytea,
+    ADD COLUMN IF NOT EXISTS file_changed bigint;
+
+CREATE TABLE IF NOT EXISTS file_dedup_state (
+    id boolean PRIMARY KEY DEFAULT true CHECK (id),
+    last_changed bigint NOT NULL
+);
+
+-- Hash the files stored before the columns existed, this reads the whole table once
+UPDATE file SET file_sha256 = sha256(file_stream) WHERE file_sha256 IS NULL AND file_stream IS NOT NULL;
+
+-- CONCURRENTLY avoids locking the file table, these can't run inside a transaction
+CREATE INDEX CONCURRENTLY IF NOT EXISTS file_sha256_idx
+    ON file (file_sha256);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS file_changed_idx
+    ON file (file_changed);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS file_title_idx
+    ON file (file_title);
+
+ANALYZE file;
@@ -0,0 +1,10 @@
+-- Lease table of the sharded mode of ftp_db_sync.py (--shards/--shard).
+-- Keeps when each shard was last finished, and by which worker,
+-- so that the shards of a worker that stopped are taken over by the others.
+CREATE TABLE IF NOT EXISTS file_sync_shard (
+    shard_count integer NOT NULL,
+    shard integer NOT NULL,
+    owner text NOT NULL,
+    finished timestamptz NOT NULL,
+    PRIMARY KEY (shard_count, shard)
+);
@@ -0,0 +1,7 @@
+-- Index used by ftp_db_sync.py to look up files by the item number
+-- in their title (the part before the first underscore).
+-- Run once before deploying the sync script, CONCURRENTLY avoids locking the file table.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS file_title_item_number_idx
+    ON file (split_part(file_title, '_', 1) text_pattern_ops);
+
+ANALYZE file;
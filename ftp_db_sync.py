@@ -1,34 +1,142 @@
 #!/usr/bin/env python3
+import argparse
+import hashlib
+import io
+import json
 import shutil
 import os
 import logging
+import queue
+import random
+import re
+import resource
+import signal
+import threading
+import time
+import zlib
 import psycopg2
+import psycopg2.pool
 from psycopg2.extras import execute_values
-from io import BytesIO
+import socket
+import string
+import sqlite3
+import struct
 import subprocess
+import tempfile
 
-from ftplib import FTP
+from ftplib import FTP, error_perm, error_temp
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path, PurePath
-from typing import List, Tuple
+from typing import List
 from collections import namedtuple
 
+try:
+    # Python-UNO bridge, shipped with LibreOffice (python3-uno)
+    import uno
+except ImportError:
+    uno = None
+
 # ********************************************** #
 # ********  CONFIGURATION VARIABLES ************
 # ********************************************** #
 
 FTP_HOST = '192.168.0.15'
+FTP_PORT = 21
 FTP_USER = 'pi'
 FTP_PASSWD = 'raspberry'
 FTP_DIR = 'FTP'
+# Maximum number of simultaneous FTP sessions kept open by one sync run
+FTP_POOL_SIZE = 4
+# Number of files fetched from FTP in parallel, capped by FTP_POOL_SIZE connections
+DOWNLOAD_WORKERS = 4
+# Idle sessions older than this (in seconds) are checked with NOOP before reuse
+FTP_KEEPALIVE = 30
+# Size and modification time of the FTP files seen by the last run. None always syncs everything
+MANIFEST_PATH = 'ftp_manifest.json'
+# Seconds a run may spend before it stops starting files, the rest is deferred
+# to the next run, where it keeps its place. None is unlimited
+RUN_BUDGET = None
+# Items whose number starts with one of these prefixes are synced first, in this order
+PRIORITY_PREFIXES = []
 
 conn_config = {
     'host': 'localhost',
     'dbname': 'postbooks',
 }
+# Maximum number of database connections kept open by one sync run
+DB_POOL_SIZE = 4
+# Sharded mode: a shard whose owner didn't finish it for this many seconds
+# is taken over by the other workers. Longer than the time between two runs
+SHARD_LEASE_TIMEOUT = 900
+# First key of the advisory locks held on shards, the second one is the shard
+SHARD_LOCK_CLASS = 0x46545053
 
 LOWRITER_COMMAND = ['lowriter', '--convert-to', 'pdf:writer_pdf_Export']
-PS_COMMAND = ['ps2pdf', '-dPDFSETTINGS=/ebook']
+PS_COMMAND = ['ps2pdf']
+# lowriter output smaller than this is kept as is, Ghostscript would cost more than it saves
+PS_MIN_BYTES = 256 * 1024
+# Ghostscript settings by average page size of the lowriter output, the last one at or below it is used.
+# Mostly text pages keep print quality, image heavy pages are downsampled
+PS_SETTINGS = [
+    (0, ['-dPDFSETTINGS=/printer']),
+    (100 * 1024, ['-dPDFSETTINGS=/ebook']),
+]
 TEMP_DIR = 'temp_files'
+# Documents converted to PDF in parallel, 0 converts in the main process
+CONVERT_WORKERS = os.cpu_count() or 1
+# Seconds a single lowriter or ps2pdf command may run before it is killed
+CONVERT_TIMEOUT = 300
+# 'lowriter' starts LOWRITER_COMMAND for every document,
+# 'office' keeps headless soffice listeners running and converts through UNO
+CONVERT_BACKEND = 'lowriter'
+OFFICE_COMMAND = ['soffice', '--headless', '--invisible', '--nologo', '--norestore', '--nodefault']
+OFFICE_PDF_FILTER = 'writer_pdf_Export'
+# A listener is restarted after this many documents, to release leaked memory
+OFFICE_MAX_DOCUMENTS = 200
+# Seconds to wait for a new listener to accept UNO connections
+OFFICE_START_TIMEOUT = 60
+# Files bigger than this are spooled to TEMP_DIR instead of being kept in memory
+SPOOL_THRESHOLD = 8 * 1024 * 1024
+# Processed files are written to the DB once this many bytes are pending
+MAX_IN_FLIGHT_BYTES = 64 * 1024 * 1024
+# or once this many files are pending: with a journal every pending file is an open file,
+# and a run of small files must not reach the limit of open files of the process
+MAX_IN_FLIGHT_FILES = 100
+# Files waiting between two processing stages, a full queue pauses the stage before it
+PIPELINE_QUEUE_SIZE = 8
+# Files are sent to the DB with one COPY per this many bytes of content
+UPLOAD_BATCH_BYTES = 64 * 1024 * 1024
+# Files from this size are streamed through a Postgres large object instead of COPY
+LARGE_OBJECT_THRESHOLD = 256 * 1024 * 1024
+LARGE_OBJECT_CHUNK = 8 * 1024 * 1024
+# Largest value a bytea column can hold
+BYTEA_MAX_BYTES = 1024 * 1024 * 1024 - 1
+# Converted PDFs are kept here between runs, keyed by source content. None disables the cache
+CACHE_DIR = 'conversion_cache'
+# Least recently used cache entries are removed above this size
+CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024
+# Compare size and SHA-256 reported by the FTP server (XSHA256 or HASH)
+# with the stored PDF files, and skip downloading the ones already stored
+PRECHECK = False
+# Durations, bytes and counts of the last run, in the Prometheus text format
+# for the node_exporter textfile collector. None disables the export
+METRICS_PATH = None
+# Also log one JSON line for every measured operation
+METRICS_JSON_LOG = False
+# Daemon mode: seconds between two polls of the FTP directory,
+# randomly shifted by up to POLL_JITTER of the interval
+POLL_INTERVAL = 300
+POLL_JITTER = 0.1
+# After a failed cycle the next one starts after POLL_RETRY_DELAY seconds,
+# doubled on every consecutive failure up to POLL_MAX_BACKOFF
+POLL_RETRY_DELAY = 30
+POLL_MAX_BACKOFF = 3600
+# State of the daemon, rewritten at every cycle for the process supervisor. None disables it
+STATUS_PATH = None
+# Progress of every file of a run, so that an interrupted run resumes where it stopped.
+# Downloaded and converted files are kept next to it until they are written. None disables it
+JOURNAL_PATH = None
 
 logging.basicConfig(format='%(asctime)s:%(levelname)s: %(message)s', level=logging.INFO)
 
@@ -45,6 +153,31 @@ NewUpload = namedtuple('NewUpload', [
     'file_name',
     'item_number'])
 
+ParsedName = namedtuple('ParsedName', [
+    'item_number',
+    'version_key',
+    'description',
+    'suffix',
+    'file_name'])
+
+FtpEntry = namedtuple('FtpEntry', [
+    'name',
+    'size',
+    'modify'])
+
+# timings are (step, seconds) pairs, measured in the conversion process,
+# compression is (lowriter bytes, ps2pdf bytes, ps2pdf CPU seconds) when ps2pdf ran,
+# failure says why the document was not converted to PDF, and retry is set when that
+# is not a verdict on the document, like a timeout or a converter that could not start
+ConversionResult = namedtuple('ConversionResult', [
+    'file_name',
+    'path',
+    'scratch_dir',
+    'timings',
+    'compression',
+    'failure',
+    'retry'], defaults=[(), None, None, False])
+
 
 class NewFile(object):
     def __init__(self, *args, **kwargs):
@@ -52,6 +185,7 @@ class NewFile(object):
         self.item_id = kwargs['item_id']
         self.file_title = kwargs['file_title']
         self.file_stream = kwargs['file_stream']
+        self.sha256 = kwargs.get('sha256')
 
     def get_description(self):
         descr = str(PurePath(self.file_title).stem).split(' ')
@@ -62,15 +196,13 @@ class NewFile(object):
     def file(self):
         return self.file_title, self.file_stream, self.get_description()
 
-    def docass(self):
-        return self.item_id, 'I', self.file_id, 'FILE', 'S', 'now()'
-
 
 class File(object):
     def __init__(self, *args, **kwargs):
         self.file_id = kwargs['file_id']
         self.file_title = kwargs['file_title']
         self.file_stream = kwargs['file_stream']
+        self.sha256 = kwargs.get('sha256')
 
     def get_description(self):
         descr = str(PurePath(self.file_title).stem).split(' ')
@@ -82,6 +214,93 @@ class File(object):
         return self.file_id, self.file_title, self.get_description(), self.file_stream
 
 
+def spooled_stream():
+    return tempfile.SpooledTemporaryFile(max_size=SPOOL_THRESHOLD, dir=TEMP_DIR)
+
+
+def stream_size(stream):
+    position = stream.tell()
+    size = stream.seek(0, os.SEEK_END)
+    stream.seek(position)
+    return size
+
+
+def payload_size(value):
+    """
+    Size of file content, kept either as a stream or as bytes
+    """
+    if hasattr(value, 'read'):
+        return stream_size(value)
+    return len(getattr(value, 'adapted', value))
+
+
+def copy_binary_chunks(rows, types):
+    """
+    Encode rows in the COPY binary format. Stream values are read in blocks,
+    so file contents are never loaded in memory as a whole.
+    """
+    yield b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)
+    for row in rows:
+        yield struct.pack('!h', len(row))
+        for value, column_type in zip(row, types):
+            if value is None:
+                yield struct.pack('!i', -1)
+            elif column_type == 'int4':
+                yield struct.pack('!ii', 4, int(value))
+            elif column_type == 'text':
+                data = str(value).encode('utf-8')
+                yield struct.pack('!i', len(data)) + data
+            elif hasattr(value, 'read'):
+                yield struct.pack('!i', stream_size(value))
+                value.seek(0)
+                for block in iter(lambda: value.read(1024 * 1024), b''):
+                    yield block
+            else:
+                data = bytes(getattr(value, 'adapted', value))
+                yield struct.pack('!i', len(data)) + data
+    yield struct.pack('!h', -1)
+
+
+class CopyStream(io.RawIOBase):
+    """
+    Read only file object over a generator of byte chunks, used as the COPY input
+    """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def readinto(self, target):
+        while not self._buffer:
+            try:
+                self._buffer = memoryview(next(self._chunks))
+            except StopIteration:
+                return 0
+        size = min(len(target), len(self._buffer))
+        target[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+
+def batches_by_size(files, max_bytes):
+    """
+    Yield lists of files with up to max_bytes of content, bigger files get a batch of their own
+    """
+    batch, batch_bytes = [], 0
+    for file in files:
+        size = payload_size(file.file_stream)
+        if batch and batch_bytes + size > max_bytes:
+            yield batch
+            batch, batch_bytes = [], 0
+        batch.append(file)
+        batch_bytes += size
+    if batch:
+        yield batch
+
+
 def temp_path(filename):
     return os.path.join(TEMP_DIR, filename)
 
@@ -90,41 +309,1200 @@ def ftp_path(filename):
     return os.path.join(FTP_DIR, filename)
 
 
-def chunks(l, n):
-    """Yield successive n-sized chunks from l."""
-    for i in range(0, len(l), n):
-        yield l[i:i + n]
+class FTPSessionPool(object):
+    """
+    A small pool of logged in FTP sessions, shared by the whole sync run.
+    Sessions are reused instead of logging in again for every file,
+    and replaced transparently when the server drops them.
+    """
+    # errors after which a session can not be used any more
+    RECONNECT_ERRORS = (EOFError, ConnectionError, TimeoutError)
 
+    def __init__(self, size=FTP_POOL_SIZE, keepalive=FTP_KEEPALIVE):
+        self.size = size
+        self.keepalive = keepalive
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
 
-def is_updated_version(db_file_name, ftp_file_name):
-    db_version = PurePath(db_file_name).stem.split('_')[1].split(' ')[0]
-    ftp_version = PurePath(ftp_file_name).stem.split('_')[1].split(' ')[0]
-    # Numbers always newer than letters
-    if ftp_version.isdigit() and db_version.isalpha():
+    @staticmethod
+    def connect():
+        ftp = FTP()
+        ftp.connect(FTP_HOST, FTP_PORT)
+        ftp.login(FTP_USER, FTP_PASSWD)
+        return ftp
+
+    @classmethod
+    def is_disconnect(cls, error):
+        """
+        421 means the server is closing the control connection
+        """
+        if isinstance(error, error_temp):
+            return str(error).startswith('421')
+        return isinstance(error, cls.RECONNECT_ERRORS)
+
+    @staticmethod
+    def discard(ftp):
+        try:
+            ftp.close()
+        except Exception:
+            pass
+
+    def _checkout(self):
+        while True:
+            try:
+                ftp, last_used = self._idle.get_nowait()
+            except queue.Empty:
+                return self.connect()
+            if time.monotonic() - last_used < self.keepalive:
+                return ftp
+            try:
+                ftp.voidcmd('NOOP')
+                return ftp
+            except Exception:
+                self.discard(ftp)
+
+    @contextmanager
+    def session(self):
+        """
+        Borrow a session from the pool, it is returned when the block exits.
+        Sessions that failed with a connection error are closed instead.
+        """
+        with self._slots:
+            ftp = self._checkout()
+            try:
+                yield ftp
+            except Exception as e:
+                if self.is_disconnect(e):
+                    self.discard(ftp)
+                else:
+                    self._idle.put((ftp, time.monotonic()))
+                raise
+            else:
+                self._idle.put((ftp, time.monotonic()))
+
+    def run(self, func):
+        """
+        Call func with a pooled session, retrying once on a fresh session
+        if the server dropped the connection.
+        """
+        try:
+            with self.session() as ftp:
+                return func(ftp)
+        except Exception as e:
+            if not self.is_disconnect(e):
+                raise
+            logging.info('FTP connection lost ({}), reconnecting'.format(e))
+        with self.session() as ftp:
+            return func(ftp)
+
+    def close(self):
+        while True:
+            try:
+                ftp, _ = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                ftp.quit()
+            except Exception:
+                self.discard(ftp)
+
+
+def kill_process_group(process):
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    process.wait()
+
+
+def run_command(command, timeout):
+    """
+    Run a conversion command in its own process group, so that the whole
+    process tree is killed if it hangs. Returns the exit status of the command,
+    or None if it could not be started or timed out.
+    """
+    try:
+        process = subprocess.Popen(
+            command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+    except OSError as e:
+        logging.error('Could not run {}: {}'.format(command[0], e))
+        return None
+    try:
+        return process.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        kill_process_group(process)
+        logging.error('{} timed out after {}s'.format(command[0], timeout))
+        return None
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class OfficeServer(object):
+    """
+    A headless soffice kept running between documents, and driven through a UNO socket.
+    It is started on first use, and restarted when it died,
+    or once it converted max_documents.
+    """
+
+    def __init__(self, max_documents=OFFICE_MAX_DOCUMENTS, timeout=CONVERT_TIMEOUT):
+        self.max_documents = max_documents
+        self.timeout = timeout
+        self.process = None
+        self.profile_dir = None
+        self.desktop = None
+        self.converted = 0
+
+    def is_running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        port = free_port()
+        self.profile_dir = tempfile.mkdtemp(prefix='office_', dir=TEMP_DIR)
+        self.process = subprocess.Popen(
+            OFFICE_COMMAND + [
+                '--accept=socket,host=127.0.0.1,port={};urp;'.format(port),
+                '-env:UserInstallation={}'.format(Path(self.profile_dir).resolve().as_uri())],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+        self.converted = 0
+        local_context = uno.getComponentContext()
+        resolver = local_context.ServiceManager.createInstanceWithContext(
+            'com.sun.star.bridge.UnoUrlResolver', local_context)
+        deadline = time.monotonic() + OFFICE_START_TIMEOUT
+        while True:
+            try:
+                context = resolver.resolve(
+                    'uno:socket,host=127.0.0.1,port={};urp;StarOffice.ComponentContext'.format(port))
+                break
+            except Exception:
+                if not self.is_running() or time.monotonic() > deadline:
+                    self.stop()
+                    raise RuntimeError('soffice listener did not start')
+                time.sleep(0.5)
+        self.desktop = context.ServiceManager.createInstanceWithContext('com.sun.star.frame.Desktop', context)
+        logging.info('Started soffice listener on port {}'.format(port))
+
+    def stop(self):
+        if self.process is not None:
+            kill_process_group(self.process)
+            self.process = None
+        if self.profile_dir is not None:
+            shutil.rmtree(self.profile_dir, ignore_errors=True)
+            self.profile_dir = None
+        self.desktop = None
+
+    @staticmethod
+    def properties(**kwargs):
+        result = []
+        for name, value in kwargs.items():
+            prop = uno.createUnoStruct('com.sun.star.beans.PropertyValue')
+            prop.Name, prop.Value = name, value
+            result.append(prop)
+        return tuple(result)
+
+    def store_pdf(self, source, dest, errors):
+        try:
+            document = self.desktop.loadComponentFromURL(
+                Path(source).resolve().as_uri(), '_blank', 0, self.properties(Hidden=True))
+            try:
+                document.storeToURL(
+                    Path(dest).resolve().as_uri(), self.properties(FilterName=OFFICE_PDF_FILTER))
+            finally:
+                document.close(True)
+        except Exception as e:
+            errors.append(e)
+
+    def convert(self, source, dest):
+        """
+        Store source as a PDF in dest. Returns True if the conversion succeeded,
+        False if soffice could not convert the document, and None if it timed out or died.
+        """
+        if not self.is_running() or self.converted >= self.max_documents:
+            self.stop()
+            self.start()
+        errors = []
+        worker = threading.Thread(target=self.store_pdf, args=(source, dest, errors), daemon=True)
+        worker.start()
+        worker.join(self.timeout)
+        self.converted += 1
+        if worker.is_alive():
+            logging.error('soffice timed out after {}s, restarting it'.format(self.timeout))
+            self.stop()
+            return None
+        if errors and not self.is_running():
+            logging.error('soffice died while converting "{}": {}'.format(source, errors[0]))
+            self.stop()
+            return None
+        if errors:
+            logging.error('soffice could not convert "{}": {}'.format(source, errors[0]))
+            return False
+        return True
+
+
+PDF_PAGE = re.compile(rb'/Type\s*/Page(?![a-zA-Z])')
+
+
+def pdf_page_count(path):
+    """
+    Number of page objects in a PDF, or None if it can't be read.
+    lowriter doesn't write compressed object streams, so pages can be found in the raw file.
+    """
+    pages, tail = 0, b''
+    try:
+        with open(path, 'rb') as pdf:
+            for block in iter(lambda: pdf.read(1024 * 1024), b''):
+                data = tail + block
+                # matches near the end may continue in the next block, they are counted with it
+                cut = max(len(data) - 32, 0)
+                pages += sum(1 for match in PDF_PAGE.finditer(data) if match.start() < cut)
+                tail = data[cut:]
+        pages += len(PDF_PAGE.findall(tail))
+    except OSError:
+        return None
+    return pages or None
+
+
+def compression_settings(size, pages):
+    """
+    Ghostscript settings for a lowriter output of size bytes, or None to keep it as is
+    """
+    if size < PS_MIN_BYTES:
+        return None
+    page_size = size / (pages or 1)
+    return [options for minimum, options in PS_SETTINGS if page_size >= minimum][-1]
+
+
+def convert_document(source_path, timeout=CONVERT_TIMEOUT, office=None) -> ConversionResult:
+    """
+    Transform a document to a compressed PDF, inside its own scratch directory
+    and with its own LibreOffice profile, so that conversions can run in parallel.
+    When an OfficeServer is given it does the first step instead of lowriter.
+    lowriter and ps2pdf don't play nice with some file names
+    to counter that we simply rename the files for processing.
+    When a step fails the output of the previous step is kept,
+    and the ps2pdf output is only kept when it is smaller.
+    """
+    filename = PurePath(source_path).name
+    scratch_dir = tempfile.mkdtemp(prefix='convert_', dir=TEMP_DIR)
+    lowriter_source = Path(scratch_dir, 'lowriter_in' + PurePath(filename).suffix)
+    shutil.move(source_path, str(lowriter_source))
+    lowriter_dest = lowriter_source.with_suffix('.pdf')
+    ps2pdf_dest = Path(scratch_dir, 'compressed.pdf')
+    profile = Path(scratch_dir, 'profile').resolve().as_uri()
+
+    logging.info('Transforming "{}"'.format(source_path))
+    started = time.monotonic()
+    if office is None:
+        lowriter_command = LOWRITER_COMMAND + [
+            '-env:UserInstallation={}'.format(profile), str(lowriter_source), '--outdir', scratch_dir]
+        status = run_command(lowriter_command, timeout)
+        # killed by a signal, it did not run to the end either
+        converted, retry = status == 0, status is None or status < 0
+        failure = 'lowriter exited with status {}'.format(status)
+    else:
+        converted = office.convert(str(lowriter_source), str(lowriter_dest))
+        retry = converted is None
+        failure = 'soffice could not convert it'
+    timings = (('lowriter', time.monotonic() - started),)
+    if retry:
+        return ConversionResult(
+            filename, str(lowriter_source), scratch_dir, timings, failure='the converter did not finish', retry=True)
+    if not converted or not lowriter_dest.is_file():
+        if converted:
+            failure = 'lowriter wrote no PDF'
+        return ConversionResult(filename, str(lowriter_source), scratch_dir, timings, failure=failure)
+    pdf_name = str(PurePath(filename).with_suffix('.pdf'))
+    lowriter_size = os.path.getsize(str(lowriter_dest))
+    settings = compression_settings(lowriter_size, pdf_page_count(str(lowriter_dest)))
+    if settings is None:
+        return ConversionResult(pdf_name, str(lowriter_dest), scratch_dir, timings)
+    started = time.monotonic()
+    # children are only accounted once waited for, this is the ps2pdf process tree
+    cpu_started = resource.getrusage(resource.RUSAGE_CHILDREN)
+    compressed = run_command(PS_COMMAND + settings + [str(lowriter_dest), str(ps2pdf_dest)], timeout) == 0
+    cpu_used = resource.getrusage(resource.RUSAGE_CHILDREN)
+    timings += (('ps2pdf', time.monotonic() - started),)
+    if not compressed or not ps2pdf_dest.is_file():
+        return ConversionResult(pdf_name, str(lowriter_dest), scratch_dir, timings)
+    compression = (
+        lowriter_size, os.path.getsize(str(ps2pdf_dest)),
+        cpu_used.ru_utime + cpu_used.ru_stime - cpu_started.ru_utime - cpu_started.ru_stime)
+    logging.info('ps2pdf "{}": {} to {} bytes ({:.0%}) in {:.2f}s CPU'.format(
+        source_path, compression[0], compression[1], compression[1] / max(compression[0], 1), compression[2]))
+    if compression[1] < lowriter_size:
+        return ConversionResult(pdf_name, str(ps2pdf_dest), scratch_dir, timings, compression)
+    return ConversionResult(pdf_name, str(lowriter_dest), scratch_dir, timings, compression)
+
+
+class ConversionEngine(object):
+    """
+    Runs convert_document jobs on a pool of worker processes.
+    With the 'office' backend, worker threads share warm OfficeServer listeners instead.
+    With no workers, jobs run in the calling process.
+    """
+
+    def __init__(self, workers=CONVERT_WORKERS, timeout=CONVERT_TIMEOUT, backend=CONVERT_BACKEND):
+        if backend == 'office' and uno is None:
+            logging.warning('Python UNO bridge is not available, converting with lowriter')
+            backend = 'lowriter'
+        self.workers = workers
+        self.timeout = timeout
+        self.backend = backend
+        self._executor = None
+        self._offices = queue.LifoQueue()
+        self._all_offices = []
+        self._offices_lock = threading.Lock()
+
+    def borrow_office(self):
+        try:
+            return self._offices.get_nowait()
+        except queue.Empty:
+            pass
+        with self._offices_lock:
+            if len(self._all_offices) < max(self.workers, 1):
+                office = OfficeServer(timeout=self.timeout)
+                self._all_offices.append(office)
+                return office
+        return self._offices.get()
+
+    def convert_with_office(self, source_path):
+        office = self.borrow_office()
+        try:
+            return convert_document(source_path, self.timeout, office)
+        finally:
+            self._offices.put(office)
+
+    def submit(self, source_path) -> Future:
+        if self.backend == 'office':
+            job, args = self.convert_with_office, (source_path,)
+        else:
+            job, args = convert_document, (source_path, self.timeout)
+        if self.workers < 1:
+            future = Future()
+            try:
+                future.set_result(job(*args))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+        if self._executor is None:
+            if self.backend == 'office':
+                self._executor = ThreadPoolExecutor(max_workers=self.workers)
+            else:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self._executor.submit(job, *args)
+
+    def profile_dirs(self):
+        """
+        Profiles of the running soffice listeners, they must survive TEMP_DIR cleanups
+        """
+        return {office.profile_dir for office in self._all_offices if office.profile_dir is not None}
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        for office in self._all_offices:
+            office.stop()
+        self._all_offices = []
+        self._offices = queue.LifoQueue()
+
+
+def stream_digest(file_stream, digest=None):
+    """
+    Hash the content of a stream, leaving it at the start
+    """
+    digest = digest or hashlib.sha256()
+    file_stream.seek(0)
+    for block in iter(lambda: file_stream.read(1024 * 1024), b''):
+        digest.update(block)
+    file_stream.seek(0)
+    return digest
+
+
+class ConversionCache(object):
+    """
+    Converted PDFs stored on disk by the SHA-256 of the source document and the converter settings.
+    Documents that could not be converted get a marker instead, so that they are kept
+    in their original format without trying again.
+    """
+
+    def __init__(self, directory=CACHE_DIR, max_bytes=CACHE_MAX_BYTES, settings=()):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.settings = repr((LOWRITER_COMMAND, PS_COMMAND, PS_MIN_BYTES, PS_SETTINGS) + tuple(settings)).encode()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def key(self, file_name, file_stream):
+        if self.directory is None:
+            return None
+        digest = hashlib.sha256(self.settings)
+        digest.update(PurePath(file_name).suffix.lower().encode())
+        return stream_digest(file_stream, digest).hexdigest()
+
+    def path(self, key, suffix):
+        return os.path.join(self.directory, key + suffix)
+
+    def load(self, key, file_name, file_stream):
+        """
+        Returns the file title and stream to upload for a cached document, or None on a miss.
+        """
+        if key is None:
+            return None
+        pdf_path, failed_path = self.path(key, '.pdf'), self.path(key, '.failed')
+        try:
+            if os.path.exists(failed_path):
+                os.utime(failed_path)
+                result = file_name, file_stream
+            else:
+                with open(pdf_path, 'rb') as fin:
+                    cached_stream = spooled_stream()
+                    shutil.copyfileobj(fin, cached_stream)
+                    cached_stream.seek(0)
+                os.utime(pdf_path)
+                file_stream.close()
+                result = str(PurePath(file_name).with_suffix('.pdf')), cached_stream
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return result
+
+    def store(self, key, result: ConversionResult):
+        if key is None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        if PurePath(result.file_name).suffix == '.pdf':
+            target = self.path(key, '.pdf')
+            temp_target = target + '.tmp{}'.format(threading.get_ident())
+            shutil.copyfile(result.path, temp_target)
+            os.replace(temp_target, target)
+        else:
+            Path(self.path(key, '.failed')).touch()
+        self.evict()
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache fits in max_bytes
+        """
+        with self._lock:
+            entries = []
+            with os.scandir(self.directory) as scan:
+                for entry in scan:
+                    if entry.name.endswith(('.pdf', '.failed')):
+                        stat = entry.stat()
+                        entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+
+class FtpManifest(object):
+    """
+    Remembers the (size, modification time) of every FTP file handled by the last run,
+    so that unchanged files are not matched against the database again,
+    and the files the last run deferred, in the order they were scheduled.
+    """
+
+    def __init__(self, path=MANIFEST_PATH):
+        self.path = path
+        self.files = {}
+        self.deferred = []
+        if path is not None and os.path.exists(path):
+            with open(path) as manifest:
+                saved = json.load(manifest)
+            self.files = {name: tuple(stat) for name, stat in saved['files'].items()}
+            self.deferred = saved.get('deferred', [])
+
+    def changed(self, entries: List[FtpEntry]):
+        """
+        Names of the entries that are new, or changed since the manifest was saved
+        """
+        if self.path is None:
+            return {entry.name for entry in entries}
+        return {
+            entry.name for entry in entries
+            if self.files.get(entry.name) != (entry.size, entry.modify)}
+
+    def save(self, entries: List[FtpEntry], failed=(), deferred=()):
+        """
+        Record the current listing, except for files that failed or were deferred, so that they are retried
+        """
+        if self.path is None:
+            return
+        self.deferred = list(deferred)
+        skipped = set(failed) | set(self.deferred)
+        self.files = {
+            entry.name: (entry.size, entry.modify) for entry in entries if entry.name not in skipped}
+        temp_manifest = self.path + '.tmp'
+        with open(temp_manifest, 'w') as manifest:
+            json.dump({'files': self.files, 'deferred': self.deferred}, manifest)
+        os.replace(temp_manifest, self.path)
+
+
+class Journal(object):
+    """
+    SQLite journal of the files handled by the current run, with local copies of the
+    downloaded and converted files in a directory next to it, outside of TEMP_DIR.
+    A restarted run takes files from where the interrupted one stopped,
+    as long as they are unchanged on FTP. It is cleared once a run finishes.
+    """
+
+    def __init__(self, path=JOURNAL_PATH):
+        self.path = path
+        self.directory = None
+        self.lock = threading.Lock()
+        self.db = None
+        if path is not None:
+            self.directory = os.path.splitext(path)[0] + '_files'
+            # autocommit, every step is on disk before the next one starts
+            self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute("""
+                CREATE TABLE IF NOT EXISTS progress (
+                    file_name TEXT PRIMARY KEY,
+                    size INTEGER,
+                    modify TEXT,
+                    state TEXT NOT NULL,
+                    stored_name TEXT,
+                    path TEXT,
+                    file_id INTEGER)""")
+
+    def local_path(self, file_name, state):
+        return os.path.join(self.directory, '{}.{}'.format(
+            hashlib.sha1(file_name.encode('utf-8')).hexdigest(), state))
+
+    def remove_copies(self, file_name):
+        for state in ('downloaded', 'converted'):
+            try:
+                os.remove(self.local_path(file_name, state))
+            except FileNotFoundError:
+                pass
+
+    def record(self, file_name, stat, state, stored_name=None, path=None, file_id=None):
+        size, modify = stat
+        with self.lock:
+            self.db.execute(
+                'INSERT OR REPLACE INTO progress VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (file_name, size, modify, state, stored_name, path, file_id))
+
+    def resume(self, file_name, stat):
+        """
+        (state, stored name, stream) of a file handled by an interrupted run, or None.
+        Written files have no stream.
+        """
+        if self.db is None:
+            return None
+        size, modify = stat
+        with self.lock:
+            row = self.db.execute(
+                'SELECT state, stored_name, path FROM progress WHERE file_name=? AND size IS ? AND modify IS ?',
+                (file_name, size, modify)).fetchone()
+        if row is None:
+            return None
+        state, stored_name, path = row
+        if state == 'written':
+            return state, stored_name, None
+        if path is None or not os.path.isfile(path):
+            return None
+        return state, stored_name, open(path, 'rb')
+
+    def download_stream(self, file_name):
+        """
+        Stream a download is written to, a file in the journal directory when it is enabled
+        """
+        if self.db is None:
+            return spooled_stream()
+        os.makedirs(self.directory, exist_ok=True)
+        return open(self.local_path(file_name, 'downloaded'), 'w+b')
+
+    def downloaded(self, file_name, stat):
+        if self.db is not None:
+            self.record(file_name, stat, 'downloaded', file_name, self.local_path(file_name, 'downloaded'))
+
+    def converted(self, file_name, stat, result: ConversionResult):
+        """
+        Move the conversion output next to the journal, and return it opened.
+        Returns None when the journal is disabled.
+        """
+        if self.db is None:
+            return None
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.local_path(file_name, 'converted')
+        shutil.move(result.path, path)
+        self.record(file_name, stat, 'converted', result.file_name, path)
+        try:
+            os.remove(self.local_path(file_name, 'downloaded'))
+        except FileNotFoundError:
+            pass
+        return open(path, 'rb')
+
+    def written(self, written_files):
+        """
+        Mark (file name, stat, stored name, file_id) tuples as committed to the database
+        """
+        if self.db is None:
+            return
+        for file_name, stat, stored_name, file_id in written_files:
+            self.record(file_name, stat, 'written', stored_name, None, file_id)
+            self.remove_copies(file_name)
+
+    def clear(self):
+        if self.db is None:
+            return
+        with self.lock:
+            self.db.execute('DELETE FROM progress')
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+
+def shard_of(item_number, shards):
+    """
+    Stable shard of an item number, the same on every host and Python version
+    """
+    return zlib.crc32(item_number.encode('utf-8')) % shards
+
+
+class ShardCoordinator(object):
+    """
+    Claims shards of the item numbers for one worker of a sharded sync.
+    A shard is held with a session advisory lock on a dedicated connection,
+    so two workers never process it at the same time, and a dead worker's
+    locks are released with its connection. file_sync_shard keeps when each
+    shard was last finished: shards of other workers are only taken over
+    once they are older than the lease timeout.
+    """
+
+    def __init__(self, shards, lease_timeout=SHARD_LEASE_TIMEOUT):
+        self.shards = shards
+        self.lease_timeout = lease_timeout
+        self.owner = '{}:{}'.format(socket.gethostname(), os.getpid())
+        self.conn = None
+
+    def cursor(self):
+        if self.conn is None or self.conn.closed:
+            self.conn = psycopg2.connect(**conn_config)
+            self.conn.autocommit = True
+        return self.conn.cursor()
+
+    def lock_key(self, shard):
+        return SHARD_LOCK_CLASS, self.shards * 65536 + shard
+
+    def claim(self, shard, own=False):
+        """
+        Lock shard, returns False if another worker holds it.
+        A shard of another worker is only claimed when its lease expired.
+        """
+        with self.cursor() as cursor:
+            cursor.execute('SELECT pg_try_advisory_lock(%s, %s);', self.lock_key(shard))
+            if not cursor.fetchone()[0]:
+                return False
+            if own:
+                return True
+            cursor.execute("""
+                SELECT finished > now() - %s * interval '1 second', owner
+                FROM file_sync_shard
+                WHERE shard_count=%s AND shard=%s;
+            """, (self.lease_timeout, self.shards, shard))
+            lease = cursor.fetchone()
+        if lease is not None and lease[0]:
+            self.release(shard)
+            return False
+        logging.info('Taking over shard {}, last finished by {}'.format(shard, lease[1] if lease else 'nobody'))
         return True
-    elif ftp_version.isalpha() and db_version.isdigit():
-        return False
-    if ftp_version.isdigit():
-        return int(ftp_version) > int(db_version)
-    return ftp_version.lower() > db_version.lower()
+
+    def finish(self, shard):
+        with self.cursor() as cursor:
+            cursor.execute("""
+                INSERT INTO file_sync_shard (shard_count, shard, owner, finished)
+                VALUES (%s, %s, %s, now())
+                ON CONFLICT (shard_count, shard) DO UPDATE SET owner=excluded.owner, finished=excluded.finished;
+            """, (self.shards, shard, self.owner))
+
+    def release(self, shard):
+        with self.cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_unlock(%s, %s);', self.lock_key(shard))
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+class WorkScheduler(object):
+    """
+    Orders the files of a run: items with a priority prefix first, then updates before
+    new files, files deferred by the last run in their previous order, and small files first.
+    Once the budget of the run is spent no more files are started.
+    """
+
+    def __init__(self, budget=RUN_BUDGET, prefixes=PRIORITY_PREFIXES):
+        self.budget = budget
+        self.prefixes = list(prefixes)
+        self.deadline = None
+
+    def start(self):
+        self.deadline = None if self.budget is None else time.monotonic() + self.budget
+
+    def expired(self):
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def prefix_rank(self, item_number):
+        for rank, prefix in enumerate(self.prefixes):
+            if item_number.startswith(prefix):
+                return rank
+        return len(self.prefixes)
+
+    def order(self, entries, ftp_stats, deferred=()):
+        """
+        VersionUpdate and NewUpload entries in the order they should be processed.
+        Files without a size in the FTP listing come after the others.
+        """
+        place = {file_name: index for index, file_name in enumerate(deferred)}
+
+        def key(entry):
+            size = ftp_stats.get(entry.file_name, (None, None))[0]
+            return (
+                self.prefix_rank(entry.item_number), isinstance(entry, NewUpload),
+                place.get(entry.file_name, len(place)), size is None, size or 0, entry.file_name)
+        return sorted(entries, key=key)
+
+
+class StatusFile(object):
+    """
+    JSON file describing the daemon, replaced at once on every update
+    so that a supervisor polling it never reads a partial state.
+    """
+
+    def __init__(self, path=STATUS_PATH):
+        self.path = path
+        self.state = {'pid': os.getpid(), 'started': time.time()}
+
+    def update(self, **fields):
+        self.state.update(fields, updated=time.time())
+        if self.path is None:
+            return
+        temp_status = self.path + '.tmp'
+        with open(temp_status, 'w') as status:
+            json.dump(self.state, status, indent=2)
+        os.replace(temp_status, self.path)
+
+
+def list_ftp_entries(ftp) -> List[FtpEntry]:
+    """
+    List FTP_DIR with sizes and modification times, using MLSD.
+    Servers without MLSD are asked for SIZE and MDTM of each file instead.
+    """
+    try:
+        return [
+            FtpEntry(name, int(facts['size']) if 'size' in facts else None, facts.get('modify'))
+            for name, facts in ftp.mlsd(FTP_DIR, facts=['type', 'size', 'modify'])
+            if facts.get('type', 'file') == 'file']
+    except error_perm:
+        pass
+    entries = []
+    for name in ftp.nlst(FTP_DIR):
+        try:
+            size = ftp.size(ftp_path(name))
+            modify = ftp.sendcmd('MDTM {}'.format(ftp_path(name))).split()[-1]
+        except error_perm:
+            size, modify = None, None
+        entries.append(FtpEntry(name, size, modify))
+    return entries
+
+
+class Metrics(object):
+    """
+    Durations, bytes moved and counts of the sync operations, summed per operation.
+    One instance is shared by all the threads of a run.
+    """
+
+    def __init__(self, json_log=METRICS_JSON_LOG):
+        self.json_log = json_log
+        self.started = time.time()
+        self.operations = {}
+        self.lock = threading.Lock()
+
+    def observe(self, operation, seconds, size=0, count=1, error=False, **details):
+        with self.lock:
+            stat = self.operations.setdefault(
+                operation, {'calls': 0, 'count': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'bytes': 0, 'errors': 0})
+            stat['calls'] += 1
+            stat['count'] += count
+            stat['seconds'] += seconds
+            stat['max_seconds'] = max(stat['max_seconds'], seconds)
+            stat['bytes'] += size
+            stat['errors'] += error
+        if self.json_log:
+            logging.info(json.dumps(dict(
+                details, operation=operation, seconds=round(seconds, 6), bytes=size, count=count, error=error)))
+
+    @contextmanager
+    def measure(self, operation, **details):
+        """
+        Time the block as one call of operation.
+        The block can set 'bytes' and 'count' on the yielded dict.
+        """
+        measured = {'bytes': 0, 'count': 1}
+        started = time.monotonic()
+        try:
+            yield measured
+        except Exception:
+            self.observe(operation, time.monotonic() - started, measured['bytes'], measured['count'],
+                         error=True, **details)
+            raise
+        self.observe(operation, time.monotonic() - started, measured['bytes'], measured['count'], **details)
+
+    PROMETHEUS_METRICS = [
+        ('calls', 'Measured calls of the operation'),
+        ('count', 'Files or rows handled by the operation'),
+        ('seconds', 'Seconds spent in the operation'),
+        ('max_seconds', 'Longest single call of the operation'),
+        ('bytes', 'Bytes moved by the operation'),
+        ('errors', 'Calls of the operation that failed'),
+    ]
+
+    def prometheus(self):
+        """
+        The operations of the last run as gauges, in the Prometheus text format
+        """
+        lines = []
+        with self.lock:
+            operations = sorted(self.operations.items())
+        for key, description in self.PROMETHEUS_METRICS:
+            name = 'ftp_db_sync_operation_{}'.format(key)
+            lines.append('# HELP {} {} in the last run.'.format(name, description))
+            lines.append('# TYPE {} gauge'.format(name))
+            for operation, stat in operations:
+                lines.append('{}{{operation="{}"}} {}'.format(name, operation, stat[key]))
+        lines.append('# HELP ftp_db_sync_last_run_timestamp_seconds Start time of the last run.')
+        lines.append('# TYPE ftp_db_sync_last_run_timestamp_seconds gauge')
+        lines.append('ftp_db_sync_last_run_timestamp_seconds {:.0f}'.format(self.started))
+        lines.append('# HELP ftp_db_sync_last_run_duration_seconds Duration of the last run.')
+        lines.append('# TYPE ftp_db_sync_last_run_duration_seconds gauge')
+        lines.append('ftp_db_sync_last_run_duration_seconds {:.3f}'.format(time.time() - self.started))
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        """
+        Replace the textfile at once, so the collector never reads half of it
+        """
+        temp_metrics = path + '.tmp'
+        with open(temp_metrics, 'w') as metrics:
+            metrics.write(self.prometheus())
+        os.replace(temp_metrics, path)
+
+    def summary(self):
+        logging.info('{:<22} {:>7} {:>7} {:>9} {:>9} {:>9} {:>9} {:>6}'.format(
+            'operation', 'calls', 'count', 'seconds', 'avg', 'max', 'MB', 'errors'))
+        with self.lock:
+            operations = sorted(self.operations.items())
+        for operation, stat in operations:
+            logging.info('{:<22} {:>7} {:>7} {:>9.2f} {:>9.3f} {:>9.3f} {:>9.1f} {:>6}'.format(
+                operation, stat['calls'], stat['count'], stat['seconds'], stat['seconds'] / stat['calls'],
+                stat['max_seconds'], stat['bytes'] / 1024 / 1024, stat['errors']))
+
+
+def remote_sha256(ftp, file_name):
+    """
+    SHA-256 of a file, computed by the FTP server with XSHA256 or HASH.
+    Returns None when the server supports neither.
+    """
+    path = ftp_path(file_name)
+    commands = [['XSHA256 {}'.format(path)], ['OPTS HASH SHA-256', 'HASH {}'.format(path)]]
+    for command in commands:
+        try:
+            for line in command:
+                response = ftp.sendcmd(line)
+        except error_perm:
+            continue
+        for token in response.split():
+            if len(token) == 64 and all(char in string.hexdigits for char in token):
+                return bytes.fromhex(token)
+    return None
+
+
+class PipelineStage(object):
+    """
+    A step of the sync pipeline, run by its own worker threads.
+    func returns the item for the next stage, or None to drop it.
+    An error in a fatal stage stops the whole pipeline, in other stages only that item is dropped.
+    measure gives the number of bytes an item moved, for the throughput report.
+    """
+
+    def __init__(self, name, func, workers=1, queue_size=PIPELINE_QUEUE_SIZE,
+                 finish=None, fatal=False, measure=None):
+        self.name = name
+        self.func = func
+        self.workers = max(workers, 1)
+        self.inbox = queue.Queue(maxsize=queue_size)
+        self.finish = finish
+        self.fatal = fatal
+        self.measure = measure
+        self.busy = 0.0
+        self.items = 0
+        self.bytes = 0
+        self.running = self.workers
+        self.lock = threading.Lock()
+
+
+class Pipeline(object):
+    """
+    Connects stages with bounded queues, so that downloads, conversions and
+    database writes of different files happen at the same time.
+    """
+    DONE = object()
+
+    def __init__(self, stages: List[PipelineStage]):
+        self.stages = stages
+        self.aborted = threading.Event()
+        self.error = None
+
+    def put(self, target, item):
+        while not self.aborted.is_set():
+            try:
+                target.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def get(self, source):
+        while not self.aborted.is_set():
+            try:
+                return source.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return self.DONE
+
+    def work(self, stage, next_stage):
+        try:
+            while True:
+                item = self.get(stage.inbox)
+                if item is self.DONE:
+                    break
+                started = time.monotonic()
+                try:
+                    result = stage.func(item)
+                except Exception as e:
+                    if stage.fatal:
+                        raise
+                    logging.error('{} failed: {}'.format(stage.name, e))
+                    result = None
+                with stage.lock:
+                    stage.busy += time.monotonic() - started
+                    stage.items += result is not None
+                    if result is not None and stage.measure is not None:
+                        stage.bytes += stage.measure(result)
+                if result is not None and next_stage is not None:
+                    self.put(next_stage.inbox, result)
+            with stage.lock:
+                stage.running -= 1
+                last_worker = stage.running == 0
+            if last_worker and not self.aborted.is_set():
+                if stage.finish is not None:
+                    started = time.monotonic()
+                    stage.finish()
+                    stage.busy += time.monotonic() - started
+                if next_stage is not None:
+                    for _ in range(next_stage.workers):
+                        self.put(next_stage.inbox, self.DONE)
+        except Exception as e:
+            self.error = e
+            self.aborted.set()
+
+    def run(self, items):
+        """
+        Feed items to the first stage, and wait until every stage is done.
+        Re-raises the error of a fatal stage.
+        """
+        start = time.monotonic()
+        threads = []
+        for index, stage in enumerate(self.stages):
+            next_stage = self.stages[index + 1] if index + 1 < len(self.stages) else None
+            for _ in range(stage.workers):
+                thread = threading.Thread(target=self.work, args=(stage, next_stage), daemon=True)
+                thread.start()
+                threads.append(thread)
+        for item in items:
+            self.put(self.stages[0].inbox, item)
+        for _ in range(self.stages[0].workers):
+            self.put(self.stages[0].inbox, self.DONE)
+        for thread in threads:
+            thread.join()
+        self.report(time.monotonic() - start)
+        if self.error is not None:
+            raise self.error
+
+    def report(self, elapsed):
+        elapsed = max(elapsed, 1e-6)
+        for stage in self.stages:
+            logging.info('{}: {} files, {:.1f} MB in {:.1f}s ({:.2f} files/s, {:.2f} MB/s), {:.0f}% busy'.format(
+                stage.name, stage.items, stage.bytes / 1024 / 1024, elapsed, stage.items / elapsed,
+                stage.bytes / elapsed / 1024 / 1024, 100 * stage.busy / (elapsed * stage.workers)))
+
+
+def version_key(version):
+    """
+    Sortable key for a revision. Numbers always newer than letters,
+    letters compare case insensitive.
+    """
+    if version.isdigit():
+        return 1, int(version), ''
+    return 0, 0, version.lower()
+
+
+def parse_file_name(file_name) -> ParsedName:
+    """
+    Split an 'ITEM_REVISION description.ext' file name in its parts
+    """
+    # plain string operations, PurePath is slow on listings with 100k+ names
+    name = file_name.rpartition('/')[2]
+    stem, dot, extension = name.rpartition('.')
+    if not stem:
+        stem, dot, extension = name, '', ''
+    parts = stem.split('_', 2)
+    version = parts[1].split(' ', 1)[0] if len(parts) > 1 else ''
+    # positional arguments, keyword construction of namedtuples is noticeably slower
+    return ParsedName(
+        file_name.split('_', 1)[0], version_key(version), stem.partition(' ')[2], dot + extension, file_name)
+
+
+def latest_revisions(file_names):
+    """
+    One pass over the file names, keeping the newest revision of every item
+    """
+    latest = {}
+    for file_name in file_names:
+        parsed = parse_file_name(file_name)
+        current = latest.get(parsed.item_number)
+        if current is None or (parsed.version_key, file_name) > (current.version_key, current.file_name):
+            latest[parsed.item_number] = parsed
+    return latest
+
+
+def is_updated_version(db_file_name, ftp_file_name):
+    return parse_file_name(ftp_file_name).version_key > parse_file_name(db_file_name).version_key
 
 
 class FileSync(object):
 
+    def __init__(self, download_workers=DOWNLOAD_WORKERS, ftp_connections=FTP_POOL_SIZE,
+                 max_in_flight_bytes=MAX_IN_FLIGHT_BYTES, max_in_flight_files=MAX_IN_FLIGHT_FILES,
+                 convert_workers=CONVERT_WORKERS,
+                 convert_timeout=CONVERT_TIMEOUT, convert_backend=CONVERT_BACKEND, cache_dir=CACHE_DIR,
+                 manifest_path=MANIFEST_PATH, full_sync=False, db_connections=DB_POOL_SIZE,
+                 upload_batch_bytes=UPLOAD_BATCH_BYTES, large_object_threshold=LARGE_OBJECT_THRESHOLD,
+                 metrics_path=METRICS_PATH, metrics_json=METRICS_JSON_LOG, status_path=STATUS_PATH,
+                 journal_path=JOURNAL_PATH, precheck=PRECHECK, shards=None, shard=0,
+                 budget=RUN_BUDGET, priority_prefixes=PRIORITY_PREFIXES):
+        self.download_workers = download_workers
+        self.max_in_flight_bytes = max_in_flight_bytes
+        self.max_in_flight_files = max_in_flight_files
+        self.upload_batch_bytes = upload_batch_bytes
+        self.large_object_threshold = large_object_threshold
+        self.ftp_pool = FTPSessionPool(size=ftp_connections)
+        self.converter = ConversionEngine(
+            workers=convert_workers, timeout=convert_timeout, backend=convert_backend)
+        self.cache = ConversionCache(
+            directory=cache_dir, settings=(self.converter.backend, OFFICE_PDF_FILTER))
+        self.manifest = FtpManifest(manifest_path)
+        self.full_sync = full_sync
+        self.db_connections = db_connections
+        self.db_pool = None
+        self.db_pool_lock = threading.Lock()
+        self.pending_updates, self.pending_new_files, self.pending_bytes = [], [], 0
+        self.pending_journal = []
+        self.items_dict = {}
+        self.ftp_entries = []
+        self.ftp_stats = {}
+        self.journal = Journal(journal_path)
+        self.precheck = precheck
+        self.remote_hashes = True
+        self.shard = shard
+        self.coordinator = None if shards is None else ShardCoordinator(shards)
+        self.scheduler = WorkScheduler(budget=budget, prefixes=priority_prefixes)
+        # files left for a later run, with the reason, they are not recorded in the manifest
+        self.deferred_files = {}
+        self.failed_files = set()
+        self.metrics_path = metrics_path
+        self.metrics = Metrics(json_log=metrics_json)
+        self.status = StatusFile(status_path)
+        self.stopping = threading.Event()
+
     def cleanup(self):
         """
-        Empty the temporary directory for file processing
+        Empty the temporary directory for file processing.
+        Profiles of running soffice listeners are kept, so they stay warm between daemon cycles.
         """
         if os.path.exists(TEMP_DIR):
-            shutil.rmtree(TEMP_DIR)
-        os.makedirs(TEMP_DIR)
+            keep = self.converter.profile_dirs()
+            for name in os.listdir(TEMP_DIR):
+                path = os.path.join(TEMP_DIR, name)
+                if path in keep:
+                    continue
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+        os.makedirs(TEMP_DIR, exist_ok=True)
+
+    @contextmanager
+    def transaction(self, cursor=None):
+        """
+        Borrow a pooled connection, everything executed with the yielded cursor
+        is committed together when the block exits, or rolled back on error.
+        When a cursor is given, its transaction is joined instead.
+        """
+        if cursor is not None:
+            yield cursor
+            return
+        with self.db_pool_lock:
+            if self.db_pool is None:
+                self.db_pool = psycopg2.pool.ThreadedConnectionPool(1, self.db_connections, **conn_config)
+        conn = self.db_pool.getconn()
+        try:
+            with conn:
+                with conn.cursor() as cursor:
+                    yield cursor
+        finally:
+            self.db_pool.putconn(conn, close=bool(conn.closed))
+
+    def close_db(self):
+        if self.db_pool is not None:
+            self.db_pool.closeall()
+            self.db_pool = None
 
     @staticmethod
-    def execute_sql(sql, params):
-        with psycopg2.connect(**conn_config) as conn:
-            with conn.cursor() as cursor:
-                cursor.execute(sql, (params,))
-                return cursor.fetchall()
+    def copy_rows(cursor, table, columns, rows):
+        """
+        Load rows into table with COPY ... FROM STDIN (FORMAT binary).
+        columns is a list of (name, type) with int4, text or bytea types.
+        """
+        sql = 'COPY {} ({}) FROM STDIN (FORMAT binary)'.format(
+            table, ', '.join(name for name, _ in columns))
+        chunks = copy_binary_chunks(rows, [column_type for _, column_type in columns])
+        cursor.copy_expert(sql, CopyStream(chunks), size=1024 * 1024)
+
+    def execute_sql(self, sql, params):
+        with self.transaction() as cursor:
+            cursor.execute(sql, (params,))
+            return cursor.fetchall()
 
     @staticmethod
     def file_name_to_item(file_name):
@@ -133,61 +1511,86 @@ class FileSync(object):
     def get_ftp_file_names(self):
         """
         Find the files that we have in FTP,
-        and create a dict with item_name to file mapping
+        and create a dict with item_name to file mapping.
+        When an item has several revisions in FTP, the newest one is used.
         """
-        with FTP(host=FTP_HOST, user=FTP_USER, passwd=FTP_PASSWD) as ftp:
-            files = ftp.nlst(FTP_DIR)
-            self.file_dict = {
-                self.file_name_to_item(file_name): file_name
-                for file_name in files if '.' in file_name}
-            return self.file_dict.keys()
+        with self.metrics.measure('ftp_list') as measured:
+            self.ftp_entries = self.ftp_pool.run(list_ftp_entries)
+            measured['count'] = len(self.ftp_entries)
+        self.ftp_stats = {entry.name: (entry.size, entry.modify) for entry in self.ftp_entries}
+        latest = latest_revisions(entry.name for entry in self.ftp_entries if '.' in entry.name)
+        self.file_dict = {item_number: parsed.file_name for item_number, parsed in latest.items()}
+        return self.file_dict.keys()
 
-    @staticmethod
-    def get_db_item_names() -> List[Tuple[str, str]]:
-        SQL = """SELECT item.item_id, item.item_number FROM item;"""
-        return [row for row in FileSync.execute_sql(SQL, None)]
+    def filter_unchanged_files(self):
+        """
+        Only keep the FTP files that are new or changed since the last run
+        """
+        if self.full_sync:
+            return self.file_dict.keys()
+        changed = self.manifest.changed(self.ftp_entries)
+        self.file_dict = {
+            item_number: file_name for item_number, file_name in self.file_dict.items()
+            if file_name in changed}
+        return self.file_dict.keys()
 
-    def filter_ftp_dir_items(self, items_in_db):
+    def match_db_items(self):
+        """
+        Keep only the FTP items that have an item record, and map them to their item_id.
+        Only the FTP item numbers are sent, and looked up through the item_number index.
         """
-        Compare DB item_number entries with FTP file_name
-        to find all the files that we are interested in
+        sql = """
+            SELECT item.item_number, item.item_id
+            FROM item
+            WHERE item.item_number = ANY(%s::text[]);
         """
-        items_in_db = [item[1] for item in items_in_db]
-        items_to_remove = filter(lambda x: x not in items_in_db, self.file_dict.keys())
-        for item in list(items_to_remove):
-            self.file_dict.pop(item)
+        with self.metrics.measure('db_match_items') as measured:
+            self.items_dict = dict(self.execute_sql(sql, sorted(self.file_dict.keys())))
+            measured['count'] = len(self.items_dict)
+        self.file_dict = {
+            item_number: file_name for item_number, file_name in self.file_dict.items()
+            if item_number in self.items_dict}
         return self.file_dict.keys()
 
     def filter_ftp_items_already_stored(self):
         """
         Filter ftp items that are already stored in the DB
         If a file exists, with file_title same as the ftp file name, then no action required.
+        The join on the item number prefix uses file_title_item_number_idx.
         """
 
         sql = """
-            SELECT file.file_title FROM file WHERE file_title SIMILAR TO %s;
+            SELECT DISTINCT file.file_title
+            FROM file
+            JOIN unnest(%s::text[]) AS ftp(stem)
+              ON split_part(file.file_title, '_', 1) = split_part(ftp.stem, '_', 1)
+             AND left(file.file_title, length(ftp.stem)) = ftp.stem;
         """
         # uploaded files will be PDF, or on their original format
         files_without_suffix = [
-            str(PurePath(file).with_suffix('')) + '%'
+            str(PurePath(file).with_suffix(''))
             for file in sorted(self.file_dict.values())]
-        sql_similar = '|'.join(files_without_suffix)
-        uploaded_files = self.execute_sql(sql, sql_similar)
+        with self.metrics.measure('db_stored_files') as measured:
+            uploaded_files = self.execute_sql(sql, files_without_suffix)
+            measured['count'] = len(uploaded_files)
         # we have all already uploaded these files, remove them from the ftp file dict
         for file_match in uploaded_files:
-            self.file_dict.pop(self.file_name_to_item(file_match[0]))
+            self.file_dict.pop(self.file_name_to_item(file_match[0]), None)
 
     def files_to_be_updated(self) -> List[VersionUpdate]:
         """
         Find which files have newer versions in FTP, and upload them
         """
         files_with_existing_versions = """
-            SELECT file.file_id, file.file_title FROM file WHERE file_title SIMILAR TO %s;
+            SELECT file.file_id, file.file_title
+            FROM file
+            WHERE split_part(file.file_title, '_', 1) = ANY(%s::text[]);
         """
-        files_from_ftp = '|'.join(sorted(self.file_dict.keys()))
-        query_filter = "({})%".format(files_from_ftp)
+        files_from_ftp = sorted(self.file_dict.keys())
 
-        files_with_versions_uploaded = self.execute_sql(files_with_existing_versions, query_filter)
+        with self.metrics.measure('db_stored_versions') as measured:
+            files_with_versions_uploaded = self.execute_sql(files_with_existing_versions, files_from_ftp)
+            measured['count'] = len(files_with_versions_uploaded)
         files_to_update = []
         for file_id, file_name in files_with_versions_uploaded:
             item_number = self.file_name_to_item(file_name)
@@ -215,156 +1618,737 @@ class FileSync(object):
                 file_name=file_name,
                 item_number=item_number) for item_number, file_name in sorted(self.file_dict.items())]
 
+    def stored_metadata(self, item_numbers):
+        """
+        (file_id, size, content digest) of the stored files of each item.
+        octet_length doesn't read the content of TOASTed values.
+        """
+        sql = """
+            SELECT split_part(file.file_title, '_', 1), file.file_id,
+                   octet_length(file.file_stream), file.file_sha256
+            FROM file
+            WHERE split_part(file.file_title, '_', 1) = ANY(%s::text[]);
+        """
+        stored = {}
+        with self.metrics.measure('db_stored_metadata') as measured:
+            for item_number, file_id, size, digest in self.execute_sql(sql, sorted(item_numbers)):
+                stored.setdefault(item_number, []).append(
+                    (file_id, size, None if digest is None else bytes(digest)))
+            measured['count'] = len(stored)
+        return stored
+
+    def skip_unchanged_downloads(self, files_to_update: List[VersionUpdate], files_to_create: List[NewUpload]):
+        """
+        Before downloading, compare the size in the FTP listing and the SHA-256 computed
+        by the FTP server with the stored files. Updates already stored only get the new
+        title, new files already stored for their item are dropped.
+        Only PDF files are compared, other files are stored converted.
+        """
+        candidates = [
+            entry for entry in list(files_to_update) + list(files_to_create)
+            if PurePath(entry.file_name).suffix == '.pdf'
+            and self.ftp_stats.get(entry.file_name, (None, None))[0] is not None]
+        if not candidates or not self.remote_hashes:
+            return files_to_update, files_to_create
+        stored = self.stored_metadata({entry.item_number for entry in candidates})
+        unchanged = set()
+        for entry in candidates:
+            size = self.ftp_stats[entry.file_name][0]
+            # a different size is a different content, no need to ask for the hash
+            digests = {
+                digest for file_id, stored_size, digest in stored.get(entry.item_number, ())
+                if stored_size == size and digest is not None
+                and (not isinstance(entry, VersionUpdate) or file_id == entry.file_id)}
+            if not digests:
+                continue
+            with self.metrics.measure('ftp_hash', file=entry.file_name):
+                digest = self.ftp_pool.run(lambda ftp: remote_sha256(ftp, entry.file_name))
+            if digest is None:
+                logging.info('FTP server does not report SHA-256, downloading every file')
+                self.remote_hashes = False
+                break
+            if digest in digests:
+                unchanged.add(entry)
+                self.metrics.observe('download_avoided', 0.0, size=size, file=entry.file_name)
+        self.rename_files([
+            File(file_id=entry.file_id, file_title=entry.file_name, file_stream=None)
+            for entry in files_to_update if entry in unchanged])
+        logging.info('{} files already stored, {:.1f} MB not downloaded'.format(
+            len(unchanged), sum(self.ftp_stats[entry.file_name][0] for entry in unchanged) / 1024 / 1024))
+        return (
+            [entry for entry in files_to_update if entry not in unchanged],
+            [entry for entry in files_to_create if entry not in unchanged])
+
     def load_ftp_file(self, filename):
         """
-        Given a filename, fetch the file from FTP, and return a stream object
+        Given a filename, fetch the file from FTP, and return a stream object.
+        Large files are spooled to disk while downloading.
+        """
+        def retrieve(ftp):
+            file_stream = self.journal.download_stream(filename)
+            try:
+                ftp.retrbinary('RETR {}'.format(ftp_path(filename)), file_stream.write)
+            except Exception:
+                file_stream.close()
+                raise
+            file_stream.seek(0)
+            return file_stream
+        with self.metrics.measure('ftp_download', file=filename) as measured:
+            file_stream = self.ftp_pool.run(retrieve)
+            measured['bytes'] = stream_size(file_stream)
+        return file_stream
+
+    def try_load_ftp_file(self, filename):
+        try:
+            return self.load_ftp_file(filename)
+        except Exception as e:
+            logging.error('Failed to download "{}": {}'.format(filename, e))
+            self.failed_files.add(filename)
+            return None
+
+    def download_entry(self, entry):
+        """
+        Pipeline stage: fetch the file of a VersionUpdate or NewUpload from FTP
         """
-        with BytesIO() as byte_stream:
-            with FTP(host=FTP_HOST, user=FTP_USER, passwd=FTP_PASSWD) as ftp:
-                ftp.retrbinary('RETR {}'.format(ftp_path(filename)), byte_stream.write)
-            byte_stream.seek(0)
-            return BytesIO(byte_stream.read())
+        if self.scheduler.expired():
+            self.defer([entry.file_name], 'run budget of {:g}s spent'.format(self.scheduler.budget))
+            return None
+        stat = self.ftp_stats.get(entry.file_name, (None, None))
+        resumed = self.journal.resume(entry.file_name, stat)
+        if resumed is not None:
+            state, stored_name, file_stream = resumed
+            logging.info('Resuming "{}", already {}'.format(entry.file_name, state))
+            if file_stream is None:
+                return None
+            return entry, stored_name, file_stream
+        file_stream = self.try_load_ftp_file(entry.file_name)
+        if file_stream is None:
+            return None
+        self.journal.downloaded(entry.file_name, stat)
+        return entry, entry.file_name, file_stream
 
     def store_stream_as_file(self, filename, file_stream):
         with open(temp_path(filename), 'wb') as temp_file:
-            temp_file.write(file_stream.read())
+            shutil.copyfileobj(file_stream, temp_file)
 
-    def transform_file(self, filename):
+    def read_conversion(self, result: ConversionResult):
         """
-        lowriter and ps2pdf don't play nice with some file names
-        to counter that we simply rename the files for processing.
+        Load the converted file in a stream, and remove its scratch directory
         """
-        source_path = temp_path(filename)
-        lowriter_source = Path(source_path)
-        lowriter_filename = temp_path('lowriter_in' + lowriter_source.suffix)
-        lowriter_source.rename(lowriter_filename)
-        lowriter_source = PurePath(lowriter_filename)
+        with open(result.path, 'rb') as fin:
+            file_stream = spooled_stream()
+            shutil.copyfileobj(fin, file_stream)
+            file_stream.seek(0)
+        shutil.rmtree(result.scratch_dir, ignore_errors=True)
+        return result.file_name, file_stream
 
-        lowriter_dest = lowriter_source.with_suffix('.pdf')
-        ps2pdf_dest = temp_path('compressed.pdf')
-
-        return_file_path = ps2pdf_dest
-        return_file_name = str(PurePath(filename).with_suffix('.pdf'))
+    def convert_entry(self, downloaded):
+        """
+        Pipeline stage: files that are not PDF are converted, unless the result is in the cache.
+        The thread waits for the conversion engine, so conversions run in parallel
+        up to the number of conversion threads.
+        """
+        entry, file_name, file_stream = downloaded
+        if PurePath(file_name).suffix == '.pdf':
+            return downloaded
+        cache_key = self.cache.key(file_name, file_stream)
+        cached = self.cache.load(cache_key, file_name, file_stream)
+        if cached is not None:
+            self.metrics.observe('convert_cache_hit', 0.0, file=file_name)
+            return (entry,) + cached
+        self.store_stream_as_file(file_name, file_stream)
+        file_stream.close()
         try:
-            logging.info('Transforming "{}"'.format(source_path))
-            subprocess.call(LOWRITER_COMMAND + [str(lowriter_source), '--outdir', TEMP_DIR])
-            subprocess.call(PS_COMMAND + [str(lowriter_dest), ps2pdf_dest])
+            with self.metrics.measure('convert', file=file_name):
+                result = self.converter.submit(temp_path(file_name)).result()
+            for step, seconds in result.timings:
+                self.metrics.observe('convert_{}'.format(step), seconds, file=file_name)
+            if result.compression is not None:
+                before, after, cpu = result.compression
+                # bytes are the size saved, count the files where ps2pdf made the document smaller
+                self.metrics.observe(
+                    'compress', cpu, size=max(before - after, 0), count=int(after < before),
+                    file=file_name, before=before, after=after)
+            if result.retry:
+                # the document is stored neither as is nor as a verdict, the next run tries again
+                logging.error('Failed to convert "{}": {}'.format(file_name, result.failure))
+                shutil.rmtree(result.scratch_dir, ignore_errors=True)
+                self.failed_files.add(entry.file_name)
+                return None
+            if result.failure is not None:
+                logging.warning('Storing "{}" as is: {}'.format(file_name, result.failure))
+            self.cache.store(cache_key, result)
+            stat = self.ftp_stats.get(entry.file_name, (None, None))
+            converted = self.journal.converted(entry.file_name, stat, result)
+            if converted is not None:
+                shutil.rmtree(result.scratch_dir, ignore_errors=True)
+                return entry, result.file_name, converted
+            return (entry,) + self.read_conversion(result)
         except Exception as e:
-            pass
-        finally:
-            if not Path(return_file_path).is_file():
-                # commands failed
-                return_file_path = str(lowriter_source)
-                return_file_name = filename
-        with open(return_file_path, 'rb') as fin:
-            return return_file_name, BytesIO(fin.read())
+            logging.error('Failed to convert "{}": {}'.format(file_name, e))
+            self.failed_files.add(file_name)
+            return None
 
-    def update_existing_files(self, files: List[File]):
+    def split_large_files(self, files):
         """
-        Insert the updated file on existing file objects
+        Separate files that are streamed through large objects from the ones sent with COPY.
+        Files too big for a bytea value are skipped, they would fail on every run.
+        """
+        small_files, large_files = [], []
+        for file in files:
+            size = payload_size(file.file_stream)
+            if size > BYTEA_MAX_BYTES:
+                logging.error('"{}" is too big to store ({} bytes), skipping'.format(file.file_title, size))
+            elif size >= self.large_object_threshold and hasattr(file.file_stream, 'read'):
+                large_files.append(file)
+            else:
+                small_files.append(file)
+        return small_files, large_files
+
+    @staticmethod
+    def store_large_object(cursor, file_stream):
+        """
+        Write the stream to a new large object, chunk by chunk, and return its oid.
+        The caller copies it to file.file_stream with lo_get, and unlinks it.
+        """
+        lobject = cursor.connection.lobject(0, 'wb')
+        file_stream.seek(0)
+        for block in iter(lambda: file_stream.read(LARGE_OBJECT_CHUNK), b''):
+            lobject.write(block)
+        lobject.close()
+        return lobject.oid
+
+    # Staging table for COPY, private to the connection and emptied on commit
+    FILE_UPLOAD_TABLE = """
+        CREATE TEMP TABLE IF NOT EXISTS file_upload (
+            ord int4, id int4, item int4, title text, descr text, stream bytea
+        ) ON COMMIT DELETE ROWS;
+        TRUNCATE file_upload;
+    """
+
+    def update_existing_files(self, files: List[File], cursor=None):
+        """
+        Insert the updated file on existing file objects, in a single transaction.
+        Each batch is copied to a staging table, and applied with one UPDATE.
+        Files with the same content as their stored revision only get the new title.
         """
         sql = """
             UPDATE file
-            SET file_title=data.title, file_descrip=data.descr, file_stream=data.stream
-            FROM (VALUES %s) as data(id, title, descr, stream)
+            SET file_title=data.title, file_descrip=data.descr, file_stream=data.stream,
+                file_sha256=sha256(data.stream), file_changed=nextval('file_changed_seq')
+            FROM file_upload AS data
             WHERE file_id=data.id;
         """
-        for file_batch in chunks(files, 5):
-            with psycopg2.connect(**conn_config) as conn:
-                with conn.cursor() as cursor:
-                    execute_values(cursor, sql, [file.file() for file in file_batch])
+        sql_large = """
+            UPDATE file
+            SET file_title=%s, file_descrip=%s, file_stream=lo.data,
+                file_sha256=sha256(lo.data), file_changed=nextval('file_changed_seq')
+            FROM (SELECT lo_get(%s) AS data) AS lo
+            WHERE file_id=%s;
+            SELECT lo_unlink(%s);
+        """
+        columns = [('id', 'int4'), ('title', 'text'), ('descr', 'text'), ('stream', 'bytea')]
+        with self.transaction(cursor) as cursor:
+            stored = {(digest, file_id) for digest, _, file_id in self.stored_contents(files, cursor)}
+            renamed = [file for file in files if (file.sha256, file.file_id) in stored]
+            self.rename_files(renamed, cursor)
+            small_files, large_files = self.split_large_files([file for file in files if file not in renamed])
+            for file_batch in batches_by_size(small_files, self.upload_batch_bytes):
+                with self.metrics.measure('db_update_batch') as measured:
+                    measured['count'] = len(file_batch)
+                    measured['bytes'] = sum(payload_size(file.file_stream) for file in file_batch)
+                    cursor.execute(self.FILE_UPLOAD_TABLE)
+                    self.copy_rows(cursor, 'file_upload', columns, [file.file() for file in file_batch])
+                    cursor.execute(sql)
+            for file in large_files:
+                with self.metrics.measure('db_update_large_object', file=file.file_title) as measured:
+                    measured['bytes'] = payload_size(file.file_stream)
+                    oid = self.store_large_object(cursor, file.file_stream)
+                    cursor.execute(sql_large, (file.file_title, file.get_description(), oid, file.file_id, oid))
+
+    def write_entry(self, converted):
+        """
+        Pipeline stage: collect processed files, and write them to the DB
+        as soon as max_in_flight_bytes or max_in_flight_files are pending. Returns the size of the file.
+        """
+        entry, file_title, file_stream = converted
+        size = stream_size(file_stream)
+        sha256 = stream_digest(file_stream).digest()
+        if isinstance(entry, VersionUpdate):
+            file = File(file_id=entry.file_id, file_title=file_title, file_stream=file_stream, sha256=sha256)
+            self.pending_updates.append(file)
+        else:
+            file = NewFile(file_title=file_title, file_stream=file_stream, item_id=entry.item_id, sha256=sha256)
+            self.pending_new_files.append(file)
+        self.pending_journal.append((entry.file_name, file))
+        self.pending_bytes += size
+        if self.pending_bytes >= self.max_in_flight_bytes or len(self.pending_journal) >= self.max_in_flight_files:
+            self.write_pending()
+        return size
+
+    def write_pending(self):
+        """
+        Write the collected files, then release their streams. Memory use is bounded
+        by max_in_flight_bytes, and open files by max_in_flight_files, not by the number of files in the run.
+        """
+        updates, new_files, journaled = self.pending_updates, self.pending_new_files, self.pending_journal
+        self.pending_updates, self.pending_new_files, self.pending_bytes = [], [], 0
+        self.pending_journal = []
+        if updates:
+            self.update_existing_files(updates)
+        if new_files:
+            self.insert_new_files(new_files)
+        for written in updates + new_files:
+            written.file_stream.close()
+        self.journal.written([
+            (file_name, self.ftp_stats.get(file_name, (None, None)), file.file_title, file.file_id)
+            for file_name, file in journaled])
+
+    def process_files(self, files_to_update: List[VersionUpdate], files_to_create: List[NewUpload]):
+        """
+        Run updates and new files through the download, conversion and upload stages.
+        Stages run at the same time, connected by bounded queues, so a slow stage
+        holds back the ones before it instead of letting files pile up in memory.
+        Files enter the pipeline in the order of the scheduler.
+        """
+        self.pending_updates, self.pending_new_files, self.pending_bytes = [], [], 0
+        self.pending_journal = []
+
+        def measure(item):
+            return stream_size(item[2])
+        self.status.update(queue_depth=len(files_to_update) + len(files_to_create))
+        pipeline = Pipeline([
+            PipelineStage('download', self.download_entry, self.download_workers, measure=measure),
+            PipelineStage('convert', self.convert_entry, self.converter.workers, measure=measure),
+            PipelineStage('upload', self.write_entry, 1, finish=self.write_pending, fatal=True, measure=int),
+        ])
+        pipeline.run(self.scheduler.order(
+            list(files_to_update) + list(files_to_create), self.ftp_stats, self.manifest.deferred))
 
     def process_updates(self, files_to_update: List[VersionUpdate]):
         """
-        Files of different format, will be fetched locally, and transformed to PDF
-        Then all files are uploaded
+        Download, transform and upload each file, without holding the whole run in memory
         """
-        transformed_files = []
-        for update in files_to_update:
-            file_title = update.file_name
-            file_stream = self.load_ftp_file(file_title)
-            if PurePath(file_title).suffix != '.pdf':
-                self.store_stream_as_file(file_title, file_stream)
-                file_title, file_stream = self.transform_file(file_title)
-            transformed_files.append(File(
-                file_id=update.file_id,
-                file_title=file_title,
-                file_stream=psycopg2.Binary(file_stream.read())))
-        return self.update_existing_files(transformed_files)
+        self.process_files(files_to_update, [])
 
-    def insert_new_files(self, files: List[NewFile]) -> List[NewFile]:
+    def insert_new_files(self, files: List[NewFile], cursor=None) -> List[NewFile]:
         """
-        Upload new files to DB, and keep track of their IDs
+        Upload new files to DB, linked to their item with a docass entry, and keep track of their IDs.
+        Each batch is copied to a staging table, where file IDs are allocated in row order,
+        so that files and links are created by one statement and matched back to the files.
+        Files whose content is already stored for their item are skipped.
         """
         sql = """
-        INSERT INTO file (file_title, file_stream, file_descrip)
-        VALUES %s
-        RETURNING file_id;
+            WITH staged AS (
+                SELECT ord, item, title, stream, descr,
+                       nextval(pg_get_serial_sequence('file', 'file_id')) AS id
+                FROM file_upload
+            ), inserted AS (
+                INSERT INTO file (file_id, file_title, file_stream, file_descrip, file_sha256, file_changed)
+                SELECT id, title, stream, descr, sha256(stream), nextval('file_changed_seq') FROM staged
+                RETURNING file_id
+            ), linked AS (
+                INSERT INTO docass (docass_source_id, docass_source_type, docass_target_id,
+                                    docass_target_type, docass_purpose, docass_created)
+                SELECT staged.item, 'I', inserted.file_id, 'FILE', 'S', now()
+                FROM staged JOIN inserted ON inserted.file_id = staged.id
+            )
+            SELECT staged.ord, inserted.file_id
+            FROM staged JOIN inserted ON inserted.file_id = staged.id;
         """
-        for file_batch in chunks(files, 5):
-            with psycopg2.connect(**conn_config) as conn:
-                with conn.cursor() as cursor:
-                    execute_values(cursor, sql, [file.file() for file in file_batch])
-                    insert_ids = cursor.fetchall()
-                    for bundle in zip(file_batch, list(insert_ids)):
-                        bundle[0].file_id = bundle[1][0]
-        return files
+        sql_large = """
+            WITH inserted AS (
+                INSERT INTO file (file_title, file_stream, file_descrip, file_sha256, file_changed)
+                SELECT title, data, descr, sha256(data), nextval('file_changed_seq')
+                FROM (SELECT %s AS title, lo_get(%s) AS data, %s AS descr) AS lo
+                RETURNING file_id
+            )
+            INSERT INTO docass (docass_source_id, docass_source_type, docass_target_id,
+                                docass_target_type, docass_purpose, docass_created)
+            SELECT %s, 'I', file_id, 'FILE', 'S', now() FROM inserted
+            RETURNING docass_target_id;
+        """
+        columns = [('ord', 'int4'), ('item', 'int4'), ('title', 'text'), ('stream', 'bytea'), ('descr', 'text')]
+        with self.transaction(cursor) as cursor:
+            stored = {(digest, item_number) for digest, item_number, _ in self.stored_contents(files, cursor)}
+            duplicates = [
+                file for file in files if (file.sha256, self.file_name_to_item(file.file_title)) in stored]
+            for file in duplicates:
+                logging.info('"{}" is already stored for its item, skipping'.format(file.file_title))
+            small_files, large_files = self.split_large_files([file for file in files if file not in duplicates])
+            for file_batch in batches_by_size(small_files, self.upload_batch_bytes):
+                with self.metrics.measure('db_insert_batch') as measured:
+                    measured['count'] = len(file_batch)
+                    measured['bytes'] = sum(payload_size(file.file_stream) for file in file_batch)
+                    cursor.execute(self.FILE_UPLOAD_TABLE)
+                    self.copy_rows(cursor, 'file_upload', columns, [
+                        (ordinal, file.item_id) + file.file() for ordinal, file in enumerate(file_batch)])
+                    cursor.execute(sql)
+                    for ordinal, file_id in cursor.fetchall():
+                        file_batch[ordinal].file_id = file_id
+            for file in large_files:
+                with self.metrics.measure('db_insert_large_object', file=file.file_title) as measured:
+                    measured['bytes'] = payload_size(file.file_stream)
+                    oid = self.store_large_object(cursor, file.file_stream)
+                    cursor.execute(sql_large, (file.file_title, oid, file.get_description(), file.item_id))
+                    file.file_id = cursor.fetchone()[0]
+                    cursor.execute('SELECT lo_unlink(%s);', (oid,))
+        return [file for file in files if file.file_id is not None]
 
-    def link_new_files(self, files: List[NewUpload]):
+    def stored_contents(self, files, cursor=None):
         """
-        Given a list of Files that have file_id and item_id, create new ls and docass entries
+        Look up the stored files with the same content as files,
+        as a set of (content digest, item number, file_id)
         """
-        sql_docass = """
-            INSERT INTO docass (docass_source_id, docass_source_type, docass_target_id, docass_target_type, docass_purpose, docass_created)
-            VALUES %s;
+        sql = """
+            SELECT file.file_sha256, split_part(file.file_title, '_', 1), file.file_id
+            FROM file
+            WHERE file.file_sha256 = ANY(%s);
         """
-        for file_batch in chunks(files, 5):
-            with psycopg2.connect(**conn_config) as conn:
-                with conn.cursor() as cursor:
-                    execute_values(cursor, sql_docass, [file.docass() for file in file_batch])
+        digests = sorted({file.sha256 for file in files if file.sha256 is not None})
+        if not digests:
+            return set()
+        with self.metrics.measure('db_stored_contents') as measured, self.transaction(cursor) as cursor:
+            cursor.execute(sql, ([psycopg2.Binary(digest) for digest in digests],))
+            stored = {(bytes(digest), item_number, file_id) for digest, item_number, file_id in cursor}
+            measured['count'] = len(stored)
+        return stored
+
+    def rename_files(self, files: List[File], cursor=None):
+        """
+        Give stored files the title of their new revision, without rewriting their content
+        """
+        sql = """
+            UPDATE file
+            SET file_title=data.title, file_descrip=data.descr, file_changed=nextval('file_changed_seq')
+            FROM (VALUES %s) AS data (id, title, descr)
+            WHERE file_id=data.id;
+        """
+        if not files:
+            return
+        with self.metrics.measure('db_rename_batch') as measured, self.transaction(cursor) as cursor:
+            measured['count'] = len(files)
+            execute_values(cursor, sql, [(file.file_id, file.file_title, file.get_description()) for file in files])
+
+    def deduplicate(self):
+        """
+        Remove files stored more than once under the same title, with their docass links.
+        The newest file of a title is kept. Only titles of files changed since the last
+        deduplication are checked, the first run checks the whole table.
+        """
+        sql = """
+            WITH last_run AS (
+                SELECT (SELECT last_changed FROM file_dedup_state) AS last_changed
+            ), changed AS (
+                SELECT DISTINCT file.file_title
+                FROM file, last_run
+                WHERE last_run.last_changed IS NULL OR file.file_changed > last_run.last_changed
+            ), ranked AS (
+                SELECT file.file_id,
+                       ROW_NUMBER() OVER (PARTITION BY file.file_title ORDER BY file.file_id DESC) AS row_num
+                FROM file
+                JOIN changed ON changed.file_title = file.file_title
+            ), duplicates AS (
+                SELECT file_id FROM ranked WHERE row_num > 1
+            ), unlinked AS (
+                DELETE FROM docass
+                WHERE docass_target_type='FILE' AND docass_source_type='I'
+                  AND docass_target_id IN (SELECT file_id FROM duplicates)
+            )
+            DELETE FROM file
+            WHERE file_id IN (SELECT file_id FROM duplicates)
+            RETURNING file_id, file_title;
+        """
+        sql_state = """
+            INSERT INTO file_dedup_state (id, last_changed) VALUES (true, %s)
+            ON CONFLICT (id) DO UPDATE SET last_changed = excluded.last_changed;
+        """
+        with self.transaction() as cursor:
+            # files changed while this runs are checked again next time
+            cursor.execute('SELECT coalesce(max(file_changed), 0) FROM file;')
+            last_changed = cursor.fetchone()[0]
+            cursor.execute(sql)
+            removed = cursor.fetchall()
+            cursor.execute(sql_state, (last_changed,))
+        for file_id, file_title in removed:
+            logging.info('Removed duplicate file {} "{}"'.format(file_id, file_title))
+        logging.info('Removed {} duplicate files'.format(len(removed)))
+        return removed
 
     def process_new_files(self, files: List[NewUpload]):
         """
         New files that don't exist in the system. Need to create LS and Docass entries and link them
         """
-        transformed_files = []
-        for file in files:
-            file_title = file.file_name
-            file_stream = self.load_ftp_file(file_title)
-            if PurePath(file_title).suffix != '.pdf':
-                self.store_stream_as_file(file_title, file_stream)
-                file_title, file_stream = self.transform_file(file_title)
-            transformed_files.append(
-                NewFile(
-                    file_title=file_title,
-                    file_stream=psycopg2.Binary(file_stream.read()),
-                    item_id=file.item_id)
-            )
-        inserted_files = self.insert_new_files(transformed_files)
-        self.link_new_files(inserted_files)
+        self.process_files([], files)
 
     def main(self):
+        try:
+            self.run_cycle()
+        finally:
+            self.close()
+
+    def close(self):
+        self.ftp_pool.close()
+        self.converter.close()
+        self.close_db()
+        self.journal.close()
+        if self.coordinator is not None:
+            self.coordinator.close()
+
+    def run_cycle(self):
+        """
+        One sync, with fresh metrics. Connections, conversion workers and the cache are kept.
+        """
+        self.metrics = Metrics(json_log=self.metrics.json_log)
+        try:
+            self.sync()
+        finally:
+            logging.info('Conversion cache: {} hits, {} misses'.format(self.cache.hits, self.cache.misses))
+            self.metrics.summary()
+            if self.metrics_path is not None:
+                self.metrics.write_prometheus(self.metrics_path)
+
+    def next_delay(self, failures, interval=POLL_INTERVAL, jitter=POLL_JITTER):
+        """
+        Seconds until the next cycle, backing off exponentially after failures
+        """
+        if failures:
+            return min(POLL_RETRY_DELAY * 2 ** (failures - 1), POLL_MAX_BACKOFF)
+        return max(interval * (1 + random.uniform(-jitter, jitter)), 0)
+
+    def stop(self, signum=None, frame=None):
+        logging.info('Stopping after the current cycle')
+        self.stopping.set()
+
+    def run_daemon(self, interval=POLL_INTERVAL, jitter=POLL_JITTER):
+        """
+        Stay resident and sync every interval seconds, until stop() is called
+        or SIGTERM/SIGINT is received. FTP sessions, database connections
+        and conversion workers stay open between cycles.
+        """
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, self.stop)
+            signal.signal(signal.SIGINT, self.stop)
+        cycles, failures = 0, 0
+        try:
+            while not self.stopping.is_set():
+                started = time.monotonic()
+                self.status.update(state='syncing', cycle_started=time.time(), queue_depth=0)
+                error = None
+                try:
+                    self.run_cycle()
+                    failures = 0
+                except Exception as e:
+                    logging.exception('Sync cycle failed')
+                    error = str(e)
+                    failures += 1
+                cycles += 1
+                delay = self.next_delay(failures, interval, jitter)
+                self.status.update(
+                    state='idle', cycles=cycles, queue_depth=0,
+                    last_cycle_seconds=round(time.monotonic() - started, 3),
+                    last_cycle_finished=time.time(), last_error=error, consecutive_failures=failures,
+                    failed_files=len(self.failed_files), deferred_files=len(self.deferred_files),
+                    next_cycle=time.time() + delay)
+                self.stopping.wait(delay)
+        finally:
+            self.status.update(state='stopped')
+            self.close()
+
+    def sync(self):
         logging.info('Begin file sync')
         self.cleanup()
+        self.scheduler.start()
+        self.failed_files = set()
+        self.deferred_files = {}
         self.get_ftp_file_names()
-        items_in_db = self.get_db_item_names()
+        changed = self.filter_unchanged_files()
+        if self.coordinator is not None:
+            self.sync_shards()
+        elif changed:
+            self.sync_files()
+        else:
+            logging.info('No changes on FTP since the last run')
+        self.report_deferred()
+        self.manifest.save(self.ftp_entries, self.failed_files, self.deferred_files)
+        self.journal.clear()
+        self.cleanup()
+
+    def defer(self, file_names, reason):
+        for file_name in file_names:
+            self.deferred_files.setdefault(file_name, reason)
+
+    def report_deferred(self):
+        """
+        Log the files left for the next run, grouped by the reason they were deferred
+        """
+        reasons = {}
+        for file_name, reason in self.deferred_files.items():
+            reasons.setdefault(reason, []).append(file_name)
+        for reason, file_names in reasons.items():
+            logging.info('Deferred {} files to the next run, {}: {}'.format(len(file_names), reason, file_names))
+        self.metrics.observe('deferred', 0.0, count=len(self.deferred_files))
+
+    def sync_shards(self):
+        """
+        Sync the items of this worker's shard, then take over the shards
+        of workers that stopped finishing theirs. Files of shards that are not
+        claimed are left for a later run.
+        """
+        shards = self.coordinator.shards
+        by_shard = {}
+        for item_number, file_name in self.file_dict.items():
+            by_shard.setdefault(shard_of(item_number, shards), {})[item_number] = file_name
+        # other workers are tried in a different order by each of them
+        for shard in [(self.shard + offset) % shards for offset in range(shards)]:
+            files = by_shard.get(shard, {})
+            own = shard == self.shard
+            if not files and not own:
+                continue
+            if files and self.scheduler.expired():
+                self.defer(sorted(files.values()), 'run budget of {:g}s spent'.format(self.scheduler.budget))
+                continue
+            if not self.coordinator.claim(shard, own=own):
+                self.defer(sorted(files.values()), 'shard {} is held by another worker'.format(shard))
+                continue
+            try:
+                if files:
+                    logging.info('Syncing {} items of shard {}'.format(len(files), shard))
+                    self.file_dict = files
+                    self.sync_files()
+                self.coordinator.finish(shard)
+            finally:
+                self.coordinator.release(shard)
 
+    def sync_files(self):
         # only work with ftp items that have db records
-        ftp_items = self.filter_ftp_dir_items(items_in_db)
+        self.match_db_items()
         self.filter_ftp_items_already_stored()
         if bool(self.file_dict) is False:
             logging.info('No files matches for upload')
             return
         files_to_update = self.files_to_be_updated()
-        items_mapping = {i[1]: i[0] for i in items_in_db}
-        files_to_create = self.files_not_in_system(items_mapping)
+        files_to_create = self.files_not_in_system(self.items_dict)
+        if self.precheck:
+            files_to_update, files_to_create = self.skip_unchanged_downloads(files_to_update, files_to_create)
         logging.info('Files to update: {}'.format([file.file_name for file in files_to_update]))
         logging.info('Files to create: {}'.format([file.file_name for file in files_to_create]))
-        self.process_updates(files_to_update)
-        self.process_new_files(files_to_create)
-        self.cleanup()
+        self.process_files(files_to_update, files_to_create)
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='Sync item revisions from FTP to the database')
+    parser.add_argument(
+        '--download-workers', type=int, default=DOWNLOAD_WORKERS,
+        help='number of files downloaded in parallel')
+    parser.add_argument(
+        '--ftp-connections', type=int, default=FTP_POOL_SIZE,
+        help='maximum number of connections opened to the FTP host')
+    parser.add_argument(
+        '--max-in-flight-mb', type=int, default=MAX_IN_FLIGHT_BYTES // 1024 // 1024,
+        help='file content held in memory before it is written to the database')
+    parser.add_argument(
+        '--max-in-flight-files', type=int, default=MAX_IN_FLIGHT_FILES,
+        help='files held before they are written to the database')
+    parser.add_argument(
+        '--convert-workers', type=int, default=CONVERT_WORKERS,
+        help='number of documents converted to PDF in parallel')
+    parser.add_argument(
+        '--convert-timeout', type=int, default=CONVERT_TIMEOUT,
+        help='seconds a conversion command may run before it is killed')
+    parser.add_argument(
+        '--convert-backend', choices=['lowriter', 'office'], default=CONVERT_BACKEND,
+        help='start lowriter per document, or keep soffice listeners running')
+    parser.add_argument(
+        '--cache-dir', default=CACHE_DIR,
+        help='directory keeping converted PDFs between runs')
+    parser.add_argument(
+        '--full', action='store_true',
+        help='match every FTP file against the database, not only files changed since the last run')
+    parser.add_argument(
+        '--db-connections', type=int, default=DB_POOL_SIZE,
+        help='maximum number of connections opened to the database')
+    parser.add_argument(
+        '--upload-batch-mb', type=int, default=UPLOAD_BATCH_BYTES // 1024 // 1024,
+        help='file content sent to the database with each COPY')
+    parser.add_argument(
+        '--large-object-mb', type=int, default=LARGE_OBJECT_THRESHOLD // 1024 // 1024,
+        help='files from this size are streamed to the database in chunks')
+    parser.add_argument(
+        '--metrics-file', default=METRICS_PATH,
+        help='write the metrics of the run to this Prometheus textfile')
+    parser.add_argument(
+        '--metrics-json', action='store_true', default=METRICS_JSON_LOG,
+        help='log one JSON line for every measured operation')
+    parser.add_argument(
+        '--daemon', action='store_true',
+        help='keep running and poll the FTP directory every --interval seconds')
+    parser.add_argument(
+        '--interval', type=float, default=POLL_INTERVAL,
+        help='seconds between two polls in daemon mode')
+    parser.add_argument(
+        '--status-file', default=STATUS_PATH,
+        help='JSON file with the state, last cycle time and queue depth of the daemon')
+    parser.add_argument(
+        '--journal', default=JOURNAL_PATH,
+        help='SQLite file recording the progress of every file, an interrupted run resumes from it')
+    parser.add_argument(
+        '--precheck', action='store_true', default=PRECHECK,
+        help='skip downloading PDF files whose size and SHA-256 on the FTP server match a stored file')
+    parser.add_argument(
+        '--shards', type=int,
+        help='split the items between this many workers, coordinated through the database')
+    parser.add_argument(
+        '--shard', type=int, default=0,
+        help='shard of the items this worker owns, from 0 to --shards - 1')
+    parser.add_argument(
+        '--budget', type=float, default=RUN_BUDGET,
+        help='seconds after which a run stops starting files, the others are left for the next run')
+    parser.add_argument(
+        '--priority-prefix', dest='priority_prefixes', action='append', default=list(PRIORITY_PREFIXES),
+        help='sync items whose number starts with this prefix first, can be repeated')
+    parser.add_argument(
+        '--dedup', action='store_true',
+        help='remove files stored twice under the same title, changed since the last --dedup, and exit')
+    parser.add_argument(
+        '--no-cache', dest='cache_dir', action='store_const', const=None,
+        help='convert every document, without the conversion cache')
+    options = parser.parse_args(args)
+    if options.shards is not None and not 0 <= options.shard < options.shards:
+        parser.error('--shard must be between 0 and --shards - 1')
+    return options
 
 
 if __name__ == "__main__":
-    process = FileSync()
-    process.main()
+    options = parse_args()
+    process = FileSync(
+        download_workers=options.download_workers,
+        ftp_connections=options.ftp_connections,
+        max_in_flight_bytes=options.max_in_flight_mb * 1024 * 1024,
+        max_in_flight_files=options.max_in_flight_files,
+        convert_workers=options.convert_workers,
+        convert_timeout=options.convert_timeout,
+        convert_backend=options.convert_backend,
+        cache_dir=options.cache_dir,
+        full_sync=options.full,
+        db_connections=options.db_connections,
+        upload_batch_bytes=options.upload_batch_mb * 1024 * 1024,
+        large_object_threshold=options.large_object_mb * 1024 * 1024,
+        metrics_path=options.metrics_file,
+        metrics_json=options.metrics_json,
+        status_path=options.status_file,
+        journal_path=options.journal,
+        precheck=options.precheck,
+        shards=options.shards,
+        shard=options.shard,
+        budget=options.budget,
+        priority_prefixes=options.priority_prefixes)
+    if options.dedup:
+        try:
+            process.deduplicate()
+        finally:
+            process.close()
+    elif options.daemon:
+        process.run_daemon(interval=options.interval)
+    else:
+        process.main()
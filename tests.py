@@ -1,18 +1,39 @@
+import hashlib
+import json
+import os
+import signal
+import struct
+import subprocess
+import tempfile
+import time
 import unittest
 import psycopg2
 from collections import OrderedDict
 from io import BytesIO
 from pathlib import Path
-from unittest.mock import patch, MagicMock, mock_open, call
-from ftp_db_sync import FileSync, VersionUpdate, NewUpload, is_updated_version, File, NewFile
+from unittest.mock import patch, MagicMock, ANY, call
+from ftplib import error_perm, error_temp
+from ftp_db_sync import (
+    ParsedName, latest_revisions, parse_file_name,
+    FileSync, VersionUpdate, NewUpload, is_updated_version, File, NewFile, FTPSessionPool,
+    ConversionCache, ConversionEngine, ConversionResult, CopyStream, FtpEntry, FtpManifest, Metrics, OfficeServer,
+    Pipeline, PipelineStage, batches_by_size, compression_settings, copy_binary_chunks, convert_document,
+    pdf_page_count, run_command, shard_of, ShardCoordinator, WorkScheduler)
 
 class TestCase(unittest.TestCase):
 
-    def test_filter_ftp_dir_items_file_exists_in_db(self):
+    @patch.object(FileSync, 'execute_sql')
+    def test_match_db_items_file_exists_in_db(self, mock_sql):
+        mock_sql.return_value = [('item1', 1)]
         sync = FileSync()
-        db_names = [('1', 'item1')]
-        sync.file_dict = {'item1': 'item1_1.txt'}
-        self.assertEqual(list(sync.filter_ftp_dir_items(db_names)), ['item1'])
+        sync.file_dict = {'item1': 'item1_1.txt', 'item2': 'item2_1.txt'}
+        self.assertEqual(list(sync.match_db_items()), ['item1'])
+        self.assertEqual(sync.items_dict, {'item1': 1})
+        sql, args = mock_sql.call_args[0]
+        self.assertEqual(
+            ' '.join(sql.split()),
+            'SELECT item.item_number, item.item_id FROM item WHERE item.item_number = ANY(%s::text[]);')
+        self.assertEqual(args, ['item1', 'item2'])
 
     def test_is_updated_version(self):
         # is_updated_version db_file ftp_file
@@ -26,17 +47,35 @@ class TestCase(unittest.TestCase):
         self.assertFalse(is_updated_version('t_b.txt', 't_a.txt'))
         self.assertFalse(is_updated_version('t_1.txt', 't_z.txt'))
 
-    def test_filter_ftp_dir_items_file_not_exists_in_db(self):
+    def test_parse_file_name(self):
+        parsed = parse_file_name('PHKIT_12 some description.doc')
+        self.assertEqual(parsed, ParsedName('PHKIT', (1, 12, ''), 'some description', '.doc',
+                                            'PHKIT_12 some description.doc'))
+        self.assertEqual(parse_file_name('PHKIT_B.pdf').version_key, (0, 0, 'b'))
+        self.assertEqual(
+            sorted(['t_2.txt', 't_a.txt', 't_10.txt', 't_B.txt'], key=lambda name: parse_file_name(name).version_key),
+            ['t_a.txt', 't_B.txt', 't_2.txt', 't_10.txt'])
+
+    def test_latest_revisions(self):
+        latest = latest_revisions(['item1_2.txt', 'item1_10.pdf', 'item1_a.doc', 'item2_b.txt', 'item2_A.txt'])
+        self.assertEqual({item: parsed.file_name for item, parsed in latest.items()},
+                         {'item1': 'item1_10.pdf', 'item2': 'item2_b.txt'})
+
+    @patch.object(FileSync, 'execute_sql')
+    def test_match_db_items_file_not_exists_in_db(self, mock_sql):
+        mock_sql.return_value = []
         sync = FileSync()
-        db_names = [('1', 'item2')]
         sync.file_dict = {'item1': 'item1_1.txt'}
-        self.assertEqual(list(sync.filter_ftp_dir_items(db_names)), [])
+        self.assertEqual(list(sync.match_db_items()), [])
 
     @patch.object(FileSync, 'execute_sql')
     def test_filter_ftp_items_already_stored_match(self, mock_sql):
         mock_sql.return_value = set([('item1_1.pdf',), ('item2_1.pdf',)])
-        expected_sql = 'SELECT file.file_title FROM file WHERE file_title SIMILAR TO %s;'
-        expected_args = 'item1_1%|item2_1%'
+        expected_sql = (
+            "SELECT DISTINCT file.file_title FROM file JOIN unnest(%s::text[]) AS ftp(stem) "
+            "ON split_part(file.file_title, '_', 1) = split_part(ftp.stem, '_', 1) "
+            "AND left(file.file_title, length(ftp.stem)) = ftp.stem;")
+        expected_args = ['item1_1', 'item2_1']
         sync = FileSync()
         sync.file_dict = OrderedDict({
             'item1': 'item1_1.txt',
@@ -44,7 +83,7 @@ class TestCase(unittest.TestCase):
         })
         sync.filter_ftp_items_already_stored()
         # fix assert so that order
-        sql = mock_sql.call_args_list[0][0][0].strip()
+        sql = ' '.join(mock_sql.call_args_list[0][0][0].split())
         args = mock_sql.call_args_list[0][0][1]
 
         self.assertEqual(expected_sql, sql)
@@ -61,10 +100,7 @@ class TestCase(unittest.TestCase):
         }
         sync.filter_ftp_items_already_stored()
         self.assertEqual(sync.file_dict, {'item1': 'item1_1.txt'})
-        mock_sql.assert_called_with(
-            '\n            SELECT file.file_title FROM file WHERE file_title SIMILAR TO %s;\n        ',
-            'item1_1%'
-        )
+        self.assertEqual(mock_sql.call_args[0][1], ['item1_1'])
 
     @patch.object(FileSync, 'execute_sql')
     def test_files_to_be_updated_query(self, mock_sql):
@@ -76,11 +112,50 @@ class TestCase(unittest.TestCase):
             'item2': 'item2_2.txt'
         }
         sync.files_to_be_updated()
-        mock_sql.assert_called_with(
+        sql, args = mock_sql.call_args[0]
+        self.assertEqual(
+            ' '.join(sql.split()),
+            "SELECT file.file_id, file.file_title FROM file "
+            "WHERE split_part(file.file_title, '_', 1) = ANY(%s::text[]);")
+        self.assertEqual(args, ['item1', 'item2'])
 
-            '\n            SELECT file.file_id, file.file_title FROM file WHERE file_title SIMILAR TO %s;\n        ',
-            ('(item1|item2)%')
-        )
+    @unittest.skipUnless(os.environ.get('TEST_DATABASE_DSN'), 'set TEST_DATABASE_DSN to check query plans')
+    def test_file_lookups_use_index(self):
+        """
+        Build a scratch file table with the migration index, and check that
+        the lookup queries are planned as index scans, not sequential scans.
+        """
+        plans = []
+        with psycopg2.connect(os.environ['TEST_DATABASE_DSN']) as conn:
+            with conn.cursor() as cursor:
+                cursor.execute('CREATE TEMP TABLE file (file_id serial PRIMARY KEY, file_title text)')
+                cursor.execute(
+                    "INSERT INTO file (file_title) "
+                    "SELECT 'item' || i || '_' || (i % 7) || '.pdf' FROM generate_series(1, 50000) i")
+                with open('file_title_item_number_index.sql') as migration:
+                    # CONCURRENTLY can't run inside the test transaction
+                    cursor.execute(migration.read().replace(' CONCURRENTLY', ''))
+                # item_number is unique in the ERP schema
+                cursor.execute('CREATE TEMP TABLE item (item_id serial PRIMARY KEY, item_number text UNIQUE)')
+                cursor.execute('SET LOCAL enable_seqscan = off')
+
+                def explain(sql, params):
+                    cursor.execute('EXPLAIN ' + sql, (params,))
+                    plans.append('\n'.join(row[0] for row in cursor.fetchall()))
+                    return []
+                with patch.object(FileSync, 'execute_sql', side_effect=explain):
+                    sync = FileSync()
+                    sync.file_dict = {'item10': 'item10_3.txt', 'item11': 'item11_4.txt'}
+                    sync.match_db_items()
+                    sync.file_dict = {'item10': 'item10_3.txt', 'item11': 'item11_4.txt'}
+                    sync.filter_ftp_items_already_stored()
+                    sync.files_to_be_updated()
+                conn.rollback()
+        self.assertEqual(len(plans), 3)
+        self.assertIn('item_item_number_key', plans[0])
+        for plan in plans[1:]:
+            self.assertIn('file_title_item_number_idx', plan)
+            self.assertNotIn('Seq Scan on file', plan)
 
     @patch.object(FileSync, 'execute_sql')
     def test_files_to_be_updated_files_to_upload(self, mock_sql):
@@ -114,20 +189,25 @@ class TestCase(unittest.TestCase):
                 {'item_number': 'item5', 'file_name': 'item5_2.txt', 'item_id': '16'},
             ])
     @patch.object(FileSync, 'update_existing_files')
-    @patch.object(FileSync, 'transform_file')
+    @patch.object(FileSync, 'read_conversion')
+    @patch('ftp_db_sync.convert_document')
     @patch.object(FileSync, 'load_ftp_file')
     @patch.object(FileSync, 'store_stream_as_file')
-    def test_process_updates_txt(self, mock_store, mock_load, mock_transform, mock_update):
+    def test_process_updates_txt(self, mock_store, mock_load, mock_convert, mock_read, mock_update):
         empty_stream = BytesIO(b'')
-        mock_transform.return_value = '/temp_files/file.pdf', empty_stream
+        result = ConversionResult('file.pdf', 'temp_files/convert_x/compressed.pdf', 'temp_files/convert_x')
+        mock_convert.return_value = result
+        mock_read.return_value = 'file.pdf', BytesIO(b'')
         mock_load.return_value = empty_stream
         files = [
             VersionUpdate(file_id='1', file_name='file.txt', item_number='1')]
-        sync = FileSync()
+        sync = FileSync(convert_workers=0, cache_dir=None)
         sync.process_updates(files)
         mock_load.assert_called_with('file.txt')
         mock_store.assert_called_with('file.txt', empty_stream)
-        mock_transform.assert_called_with('file.txt')
+        mock_convert.assert_called_with('temp_files/file.txt', sync.converter.timeout)
+        mock_read.assert_called_with(result)
+        self.assertEqual(mock_update.call_args[0][0][0].file_title, 'file.pdf')
 
     @patch.object(FileSync, 'update_existing_files')
     @patch.object(FileSync, 'load_ftp_file')
@@ -142,10 +222,133 @@ class TestCase(unittest.TestCase):
         mock_load.assert_called_with('file.pdf')
         mock_store.assert_not_called()
 
+    @patch.object(FileSync, 'write_pending')
+    @patch.object(FileSync, 'load_ftp_file')
+    def test_process_files_download_failures(self, mock_load, mock_write):
+        def load(filename):
+            if filename == 'bad.pdf':
+                raise EOFError()
+            return BytesIO(filename.encode())
+        mock_load.side_effect = load
+        files = [VersionUpdate(file_id=name, file_name=name, item_number='f')
+                 for name in ['a.pdf', 'bad.pdf', 'c.pdf', 'd.pdf']]
+        sync = FileSync(download_workers=3)
+        sync.process_updates(files)
+        self.assertEqual(sorted(file.file_id for file in sync.pending_updates), ['a.pdf', 'c.pdf', 'd.pdf'])
+        self.assertEqual(sync.failed_files, {'bad.pdf'})
+        mock_write.assert_called_once_with()
+
+    def test_pipeline_stages(self):
+        seen = []
+        pipeline = Pipeline([
+            PipelineStage('double', lambda x: x * 2, workers=3, queue_size=1),
+            PipelineStage('drop', lambda x: None if x == 4 else x, workers=2, queue_size=1),
+            PipelineStage('collect', lambda x: seen.append(x) or x, queue_size=1,
+                          finish=lambda: seen.append('done')),
+        ])
+        pipeline.run(range(10))
+        self.assertEqual(sorted(seen[:-1]), [0, 2, 6, 8, 10, 12, 14, 16, 18])
+        self.assertEqual(seen[-1], 'done')
+        self.assertEqual(pipeline.stages[1].items, 9)
+
+    def test_pipeline_fatal_stage(self):
+        def fail(item):
+            raise RuntimeError('database down')
+        pipeline = Pipeline([
+            PipelineStage('produce', lambda x: x, workers=2, queue_size=1),
+            PipelineStage('write', fail, fatal=True, queue_size=1),
+        ])
+        with self.assertRaises(RuntimeError):
+            pipeline.run(range(100))
+
+    @patch.object(FileSync, 'update_existing_files')
+    @patch.object(FileSync, 'load_ftp_file')
+    def test_process_updates_skips_failed_download(self, mock_load, mock_update):
+        mock_load.side_effect = [EOFError(), BytesIO(b'abc')]
+        files = [
+            VersionUpdate(file_id='1', file_name='one.pdf', item_number='one'),
+            VersionUpdate(file_id='2', file_name='two.pdf', item_number='two')]
+        sync = FileSync(download_workers=1)
+        sync.process_updates(files)
+        updated = mock_update.call_args[0][0]
+        self.assertEqual([file.file_id for file in updated], ['2'])
+
+    @patch.object(FileSync, 'update_existing_files')
+    @patch.object(FileSync, 'load_ftp_file')
+    def test_process_updates_bounded_batches(self, mock_load, mock_update):
+        written = []
+        mock_update.side_effect = lambda batch: written.append([file.file_id for file in batch])
+        mock_load.side_effect = [BytesIO(b'x' * 10) for _ in range(5)]
+        files = [
+            VersionUpdate(file_id=str(i), file_name='f{}.pdf'.format(i), item_number='f')
+            for i in range(5)]
+        sync = FileSync(download_workers=1, convert_workers=0, max_in_flight_bytes=20)
+        sync.process_updates(files)
+        self.assertEqual(written, [['0', '1'], ['2', '3'], ['4']])
+
+    @patch.object(FileSync, 'update_existing_files')
+    @patch.object(FileSync, 'load_ftp_file')
+    def test_process_updates_bounded_file_count(self, mock_load, mock_update):
+        written = []
+        mock_update.side_effect = lambda batch: written.append([file.file_id for file in batch])
+        mock_load.side_effect = [BytesIO(b'x') for _ in range(5)]
+        files = [
+            VersionUpdate(file_id=str(i), file_name='f{}.pdf'.format(i), item_number='f')
+            for i in range(5)]
+        sync = FileSync(download_workers=1, convert_workers=0, max_in_flight_files=2)
+        sync.process_updates(files)
+        self.assertEqual(written, [['0', '1'], ['2', '3'], ['4']])
+
+    @staticmethod
+    def read_copy_binary(data):
+        """
+        Decode COPY binary data back into rows of raw field values
+        """
+        assert data.startswith(b'PGCOPY\n\xff\r\n\x00')
+        offset, rows = 19, []
+        while True:
+            (fields,) = struct.unpack_from('!h', data, offset)
+            offset += 2
+            if fields == -1:
+                return rows
+            row = []
+            for _ in range(fields):
+                (size,) = struct.unpack_from('!i', data, offset)
+                offset += 4
+                row.append(None if size == -1 else data[offset:offset + size])
+                offset += max(size, 0)
+            rows.append(row)
+
+    def mock_copy(self, mock_psycopg2):
+        """
+        Capture the rows sent with each COPY on the pooled connection
+        """
+        conn = mock_psycopg2.pool.ThreadedConnectionPool.return_value.getconn.return_value
+        conn.closed = 0
+        cursor = conn.cursor().__enter__()
+        copies = []
+        cursor.copy_expert.side_effect = lambda sql, stream, size: copies.append(
+            (sql, self.read_copy_binary(stream.read())))
+        return cursor, copies
+
+    def test_copy_binary_chunks(self):
+        rows = [(1, 'tést', None, BytesIO(b'stream')), (2, 'two', 'x', psycopg2.Binary(b'bin'))]
+        data = b''.join(copy_binary_chunks(rows, ['int4', 'text', 'text', 'bytea']))
+        self.assertEqual(self.read_copy_binary(data), [
+            [b'\x00\x00\x00\x01', 'tést'.encode(), None, b'stream'],
+            [b'\x00\x00\x00\x02', b'two', b'x', b'bin'],
+        ])
+        self.assertEqual(CopyStream(copy_binary_chunks(rows, ['int4', 'text', 'text', 'bytea'])).read(), data)
+
+    def test_batches_by_size(self):
+        files = [File(file_id=i, file_title='f', file_stream=BytesIO(b'x' * size))
+                 for i, size in enumerate([4, 4, 10, 1, 1])]
+        batches = [[file.file_id for file in batch] for batch in batches_by_size(files, 8)]
+        self.assertEqual(batches, [[0, 1], [2], [3, 4]])
+
     @patch('ftp_db_sync.psycopg2')
-    @patch('ftp_db_sync.execute_values')
-    def test_update_existing_files(self, mock_extras,  mock_psycopg2):
-        mock_psycopg2.cursor.return_value.execute.fetch_all = []
+    def test_update_existing_files(self, mock_psycopg2):
+        cursor, copies = self.mock_copy(mock_psycopg2)
         files = [
             File(file_id='1', file_title='hello.txt', file_stream=BytesIO(b'onetwothree')),
             File(file_id='1', file_title='hello.txt', file_stream=BytesIO(b'onetwothree')),
@@ -154,74 +357,358 @@ class TestCase(unittest.TestCase):
             File(file_id='1', file_title='hello.txt', file_stream=BytesIO(b'onetwothree')),
             File(file_id='1', file_title='hello.txt', file_stream=BytesIO(b'onetwothree')),
         ]
-        sync = FileSync()
+        sync = FileSync(upload_batch_bytes=25)
         sync.update_existing_files(files)
-        self.assertEqual(mock_extras.call_count, 2)
+        self.assertEqual(len(copies), 3)
+        self.assertEqual(copies[0][0], 'COPY file_upload (id, title, descr, stream) FROM STDIN (FORMAT binary)')
+        self.assertEqual(copies[0][1][0], [b'\x00\x00\x00\x01', b'hello.txt', b'hello', b'onetwothree'])
+        self.assertIn('FROM file_upload AS data', cursor.execute.call_args[0][0])
+        batches = sync.metrics.operations['db_update_batch']
+        self.assertEqual((batches['calls'], batches['count'], batches['bytes']), (3, 6, 66))
 
-    @patch('ftp_db_sync.psycopg2')
     @patch('ftp_db_sync.execute_values')
-    def test_insert_new_files(self, mock_extras,  mock_psycopg2):
-        expected = ['10', '2', '3', '4', '5']
-        mock_psycopg2.connect().__enter__().cursor().__enter__().fetchall.return_value = [('10',), ('2',), ('3',), ('4',), ('5',)]
+    @patch('ftp_db_sync.psycopg2')
+    def test_stored_content_is_not_written_again(self, mock_psycopg2, mock_extras):
+        cursor, copies = self.mock_copy(mock_psycopg2)
+        same, changed = hashlib.sha256(b'same').digest(), hashlib.sha256(b'changed').digest()
+        cursor.__iter__.side_effect = lambda: iter([(same, 'item1', 1)])
+        sync = FileSync()
+        sync.update_existing_files([
+            File(file_id=1, file_title='item1_2 new.pdf', file_stream=BytesIO(b'same'), sha256=same),
+            File(file_id=2, file_title='item2_2.pdf', file_stream=BytesIO(b'changed'), sha256=changed)])
+        self.assertEqual(mock_extras.call_args[0][2], [(1, 'item1_2 new.pdf', 'new')])
+        self.assertEqual([row[0] for row in copies[0][1]], [b'\x00\x00\x00\x02'])
+
+        cursor.fetchall.return_value = [(0, 10)]
+        files = sync.insert_new_files([
+            NewFile(item_id=1, file_title='item1_3.pdf', file_stream=BytesIO(b'same'), sha256=same),
+            NewFile(item_id=2, file_title='item2_3.pdf', file_stream=BytesIO(b'same'), sha256=same)])
+        self.assertEqual([(file.file_title, file.file_id) for file in files], [('item2_3.pdf', 10)])
+        self.assertEqual(len(copies[1][1]), 1)
+
+    @patch.object(FileSync, 'rename_files')
+    @patch.object(FileSync, 'execute_sql')
+    @patch('ftp_db_sync.FTP')
+    def test_precheck_skips_stored_files(self, mock_ftp, mock_sql, mock_rename):
+        same, other = hashlib.sha256(b'same').digest(), hashlib.sha256(b'other').digest()
+        mock_ftp.return_value.sendcmd.side_effect = lambda command: '213 ' + (
+            same.hex() if 'item1_2.pdf' in command or 'item3_1.pdf' in command else other.hex())
+        mock_sql.return_value = [
+            ('item1', 1, 4, same), ('item2', 2, 4, same), ('item3', 3, 4, same), ('item4', 4, 9, same)]
+        sync = FileSync()
+        sync.ftp_stats = {name: (4, '1') for name in ['item1_2.pdf', 'item2_2.pdf', 'item3_1.pdf', 'item4_2.pdf']}
+        updates = [VersionUpdate(1, 'item1_2.pdf', 'item1'), VersionUpdate(2, 'item2_2.pdf', 'item2'),
+                   VersionUpdate(4, 'item4_2.pdf', 'item4')]
+        creates = [NewUpload(3, 'item3_1.pdf', 'item3'), NewUpload(5, 'item5_1.txt', 'item5')]
+        updates, creates = sync.skip_unchanged_downloads(updates, creates)
+        self.assertEqual([entry.file_name for entry in updates], ['item2_2.pdf', 'item4_2.pdf'])
+        self.assertEqual([entry.file_name for entry in creates], ['item5_1.txt'])
+        self.assertEqual([file.file_title for file in mock_rename.call_args[0][0]], ['item1_2.pdf'])
+        # item4 differs in size, its hash is not asked for
+        self.assertEqual(mock_ftp.return_value.sendcmd.call_count, 3)
+        self.assertEqual(sync.metrics.operations['download_avoided']['bytes'], 8)
+
+    @patch.object(FileSync, 'execute_sql', return_value=[('item1', 1, 4, b'x')])
+    @patch('ftp_db_sync.FTP')
+    def test_precheck_without_server_hashes(self, mock_ftp, mock_sql):
+        mock_ftp.return_value.sendcmd.side_effect = error_perm('500 Unknown command')
+        sync = FileSync()
+        sync.ftp_stats = {'item1_2.pdf': (4, '1')}
+        updates = [VersionUpdate(1, 'item1_2.pdf', 'item1')]
+        self.assertEqual(sync.skip_unchanged_downloads(updates, []), (updates, []))
+        self.assertFalse(sync.remote_hashes)
+
+    @patch('ftp_db_sync.psycopg2')
+    def test_deduplicate_remembers_last_change(self, mock_psycopg2):
+        cursor, _ = self.mock_copy(mock_psycopg2)
+        cursor.fetchone.return_value = (42,)
+        cursor.fetchall.return_value = [(7, 'item1_1.pdf')]
+        self.assertEqual(FileSync().deduplicate(), [(7, 'item1_1.pdf')])
+        self.assertIn('file_changed > last_run.last_changed', cursor.execute.call_args_list[1][0][0])
+        cursor.execute.assert_called_with(ANY, (42,))
+
+    def test_metrics_prometheus_export(self):
+        metrics = Metrics()
+        metrics.observe('ftp_download', 0.5, size=100)
+        with self.assertRaises(ValueError):
+            with metrics.measure('ftp_download') as measured:
+                measured['bytes'] = 50
+                raise ValueError()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'ftp_db_sync.prom')
+            metrics.write_prometheus(path)
+            with open(path) as textfile:
+                lines = textfile.read().splitlines()
+        self.assertIn('# TYPE ftp_db_sync_operation_seconds gauge', lines)
+        self.assertIn('ftp_db_sync_operation_calls{operation="ftp_download"} 2', lines)
+        self.assertIn('ftp_db_sync_operation_bytes{operation="ftp_download"} 150', lines)
+        self.assertIn('ftp_db_sync_operation_errors{operation="ftp_download"} 1', lines)
+
+    @patch('ftp_db_sync.psycopg2')
+    def test_insert_new_files(self, mock_psycopg2):
+        expected = [10, 2, 3, 4, 5]
+        cursor, copies = self.mock_copy(mock_psycopg2)
+        # returned rows are not in insert order
+        cursor.fetchall.return_value = [(1, 2), (0, 10), (3, 4), (2, 3), (4, 5)]
 
         files = [
-            NewFile(item_id='1', file_title='one', file_stream=psycopg2.Binary(b'123123')),
-            NewFile(item_id='2', file_title='one', file_stream=psycopg2.Binary(b'123123')),
-            NewFile(item_id='3', file_title='one', file_stream=psycopg2.Binary(b'123123')),
-            NewFile(item_id='4', file_title='one', file_stream=psycopg2.Binary(b'123123')),
-            NewFile(item_id='5', file_title='one', file_stream=psycopg2.Binary(b'123123')),
+            NewFile(item_id=1, file_title='one', file_stream=psycopg2.Binary(b'123123')),
+            NewFile(item_id=2, file_title='one', file_stream=psycopg2.Binary(b'123123')),
+            NewFile(item_id=3, file_title='one', file_stream=psycopg2.Binary(b'123123')),
+            NewFile(item_id=4, file_title='one', file_stream=psycopg2.Binary(b'123123')),
+            NewFile(item_id=5, file_title='one', file_stream=psycopg2.Binary(b'123123')),
         ]
         sync = FileSync()
         files = sync.insert_new_files(files)
-        for bundle in zip(files, expected):
-            self.assertEqual(bundle[0].file_id, bundle[1])
-
-    @patch('ftp_db_sync.open', new_callable=mock_open, read_data=b"data")
-    @patch('ftp_db_sync.subprocess.call')
-    @patch.object(Path, 'is_file')
-    @patch.object(Path, 'rename')
-    def test_transform_function(self, mock_rename, mock_path, mock_subprocess, mock_open):
-        mock_subprocess.call.return_value = None
-        mock_path.return_value = True
-        expected_call_one = ['lowriter', '--convert-to', 'pdf:writer_pdf_Export', 'temp_files/lowriter_in.txt', '--outdir', 'temp_files']
-        expected_call_two = ['ps2pdf', '-dPDFSETTINGS=/ebook', 'temp_files/lowriter_in.pdf', 'temp_files/compressed.pdf']
-        expected_calls = [call(expected_call_one), call(expected_call_two)]
-        sync = FileSync()
-        result = sync.transform_file('file.txt')
-        self.assertEqual(mock_subprocess.call_count, 2)
-        self.assertEqual(result[0], 'file.pdf')
-        self.assertTrue(mock_subprocess.call_args_list[0], expected_call_one)
-        mock_subprocess.assert_has_calls(expected_calls)
-        mock_open.assert_called_with('temp_files/compressed.pdf', 'rb')
-
-    @patch('ftp_db_sync.open', new_callable=mock_open, read_data=b"data")
-    @patch('ftp_db_sync.subprocess.call')
-    @patch.object(Path, 'is_file')
-    @patch.object(Path, 'rename')
-    def test_transform_function_silent_fail(self, mock_rename, mock_path, mock_subprocess, mock_open):
-        mock_subprocess.call.return_value = None
-        mock_path.return_value = False
-        expected_call_one = ['lowriter', '--convert-to', 'pdf:writer_pdf_Export', 'temp_files/lowriter_in.txt', '--outdir', 'temp_files']
-        expected_call_two = ['ps2pdf', '-dPDFSETTINGS=/ebook', 'temp_files/lowriter_in.pdf', 'temp_files/compressed.pdf']
-        expected_calls = [call(expected_call_one), call(expected_call_two)]
-        sync = FileSync()
-        result = sync.transform_file('file.txt')
-        self.assertEqual(mock_subprocess.call_count, 2)
-        self.assertEqual(result[0], 'file.txt')
-        self.assertTrue(mock_subprocess.call_args_list[0], expected_call_one)
-        mock_subprocess.assert_has_calls(expected_calls)
-        mock_open.assert_called_with('temp_files/lowriter_in.txt', 'rb')
-
-    @patch('ftp_db_sync.open', new_callable=mock_open, read_data=b"data")
-    @patch('ftp_db_sync.subprocess.call')
-    @patch.object(Path, 'rename')
-    def test_transform_function_error(self, mock_rename, mock_subprocess, mock_open):
-        mock_subprocess.side_effect = Exception('exception')
-        sync = FileSync()
-        result = sync.transform_file('file.txt')
-        self.assertEqual(mock_subprocess.call_count, 1)
-        self.assertEqual(result[0], 'file.txt')
-        mock_open.assert_called_with('temp_files/lowriter_in.txt', 'rb')
+        self.assertEqual([file.file_id for file in files], expected)
+        self.assertEqual(len(copies), 1)
+        self.assertEqual(copies[0][1][1], [b'\x00\x00\x00\x01', b'\x00\x00\x00\x02', b'one', b'123123', b'one'])
+
+    @patch('ftp_db_sync.psycopg2')
+    @patch('ftp_db_sync.execute_values')
+    def test_new_files_linked_in_one_transaction(self, mock_extras, mock_psycopg2):
+        db_pool = mock_psycopg2.pool.ThreadedConnectionPool.return_value
+        conn = db_pool.getconn.return_value
+        cursor, copies = self.mock_copy(mock_psycopg2)
+        cursor.fetchall.return_value = [(0, 10)]
+        sync = FileSync(download_workers=1, convert_workers=0)
+        with patch.object(FileSync, 'load_ftp_file', return_value=BytesIO(b'pdf')):
+            sync.process_new_files([NewUpload(item_id=1, file_name='item1_1.pdf', item_number='item1')])
+        self.assertEqual(db_pool.getconn.call_count, 1)
+        self.assertEqual(len(copies), 1)
+        self.assertEqual(copies[0][1][0][:2], [b'\x00\x00\x00\x00', b'\x00\x00\x00\x01'])
+        # links are created by the insert itself
+        self.assertTrue(any('INSERT INTO docass' in args[0][0] for args in cursor.execute.call_args_list))
+        mock_extras.assert_not_called()
+        db_pool.putconn.assert_called_with(conn, close=False)
+        sync.close_db()
+        db_pool.closeall.assert_called_with()
+
+    @patch('ftp_db_sync.LARGE_OBJECT_CHUNK', 4)
+    @patch('ftp_db_sync.psycopg2')
+    def test_insert_large_files_as_large_objects(self, mock_psycopg2):
+        cursor, copies = self.mock_copy(mock_psycopg2)
+        cursor.fetchall.return_value = [(0, 7)]
+        cursor.fetchone.return_value = (8,)
+        lobject = cursor.connection.lobject.return_value
+        lobject.oid = 555
+        files = [
+            NewFile(item_id=1, file_title='item1_1.pdf', file_stream=BytesIO(b'small')),
+            NewFile(item_id=2, file_title='item2_1 big.pdf', file_stream=BytesIO(b'0123456789')),
+        ]
+        sync = FileSync(large_object_threshold=10)
+        files = sync.insert_new_files(files)
+        self.assertEqual([file.file_id for file in files], [7, 8])
+        self.assertEqual(len(copies[0][1]), 1)
+        self.assertEqual(lobject.write.call_args_list, [call(b'0123'), call(b'4567'), call(b'89')])
+        cursor.execute.assert_any_call(ANY, ('item2_1 big.pdf', 555, 'big', 2))
+        cursor.execute.assert_called_with('SELECT lo_unlink(%s);', (555,))
+
+    @patch('ftp_db_sync.BYTEA_MAX_BYTES', 4)
+    def test_split_large_files_skips_oversized(self):
+        files = [
+            File(file_id=1, file_title='ok.pdf', file_stream=BytesIO(b'1234')),
+            File(file_id=2, file_title='huge.pdf', file_stream=BytesIO(b'12345')),
+        ]
+        self.assertEqual(FileSync().split_large_files(files), (files[:1], []))
+        self.assertEqual(FileSync(large_object_threshold=2).split_large_files(files), ([], files[:1]))
+
+    def conversion_calls(self):
+        profile = Path('temp_files/convert_x/profile').resolve().as_uri()
+        return [
+            call(['lowriter', '--convert-to', 'pdf:writer_pdf_Export',
+                  '-env:UserInstallation={}'.format(profile),
+                  'temp_files/convert_x/lowriter_in.txt', '--outdir', 'temp_files/convert_x'],
+                 stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True),
+            call(['ps2pdf', '-dPDFSETTINGS=/ebook',
+                  'temp_files/convert_x/lowriter_in.pdf', 'temp_files/convert_x/compressed.pdf'],
+                 stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True),
+        ]
+
+    @patch('ftp_db_sync.subprocess.Popen')
+    @patch('ftp_db_sync.shutil.move')
+    @patch('ftp_db_sync.tempfile.mkdtemp', return_value='temp_files/convert_x')
+    @patch.object(Path, 'is_file', return_value=True)
+    @patch('ftp_db_sync.os.path.getsize', side_effect=[1024 * 1024, 512 * 1024])
+    def test_convert_document(self, mock_getsize, mock_is_file, mock_mkdtemp, mock_move, mock_popen):
+        mock_popen.return_value.wait.return_value = 0
+        result = convert_document('temp_files/file.txt')
+        mock_move.assert_called_with('temp_files/file.txt', 'temp_files/convert_x/lowriter_in.txt')
+        self.assertEqual(mock_popen.call_args_list, self.conversion_calls())
+        self.assertEqual(result[:3], ConversionResult(
+            'file.pdf', 'temp_files/convert_x/compressed.pdf', 'temp_files/convert_x')[:3])
+        self.assertEqual([step for step, _ in result.timings], ['lowriter', 'ps2pdf'])
+        self.assertEqual(result.compression[:2], (1024 * 1024, 512 * 1024))
+
+    @patch('ftp_db_sync.subprocess.Popen')
+    @patch('ftp_db_sync.shutil.move')
+    @patch('ftp_db_sync.tempfile.mkdtemp', return_value='temp_files/convert_x')
+    @patch.object(Path, 'is_file', return_value=True)
+    @patch('ftp_db_sync.os.path.getsize')
+    def test_convert_document_keeps_smaller_file(self, mock_getsize, mock_is_file, mock_mkdtemp, mock_move,
+                                                 mock_popen):
+        mock_popen.return_value.wait.return_value = 0
+        mock_getsize.side_effect = [1024 * 1024, 2 * 1024 * 1024]
+        result = convert_document('temp_files/file.txt')
+        self.assertEqual(result.path, 'temp_files/convert_x/lowriter_in.pdf')
+        # small documents are not compressed
+        mock_popen.reset_mock()
+        mock_getsize.side_effect = [1024]
+        result = convert_document('temp_files/file.txt')
+        self.assertEqual(mock_popen.call_count, 1)
+        self.assertEqual(result.path, 'temp_files/convert_x/lowriter_in.pdf')
+
+    def test_compression_settings(self):
+        self.assertIsNone(compression_settings(1024, None))
+        self.assertEqual(compression_settings(1024 * 1024, None), ['-dPDFSETTINGS=/ebook'])
+        self.assertEqual(compression_settings(1024 * 1024, 50), ['-dPDFSETTINGS=/printer'])
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'doc.pdf')
+            with open(path, 'wb') as pdf:
+                pdf.write(b'<< /Type /Pages /Count 2 >> << /Type /Page >> <</Type/Page>>')
+            self.assertEqual(pdf_page_count(path), 2)
+
+    @patch('ftp_db_sync.subprocess.Popen')
+    @patch('ftp_db_sync.shutil.move')
+    @patch('ftp_db_sync.tempfile.mkdtemp', return_value='temp_files/convert_x')
+    @patch.object(Path, 'is_file', return_value=False)
+    def test_convert_document_silent_fail(self, mock_is_file, mock_mkdtemp, mock_move, mock_popen):
+        mock_popen.return_value.wait.return_value = 0
+        result = convert_document('temp_files/file.txt')
+        self.assertEqual(mock_popen.call_count, 1)
+        self.assertEqual(result.file_name, 'file.txt')
+        self.assertEqual(result.path, 'temp_files/convert_x/lowriter_in.txt')
+        self.assertEqual((result.failure, result.retry), ('lowriter wrote no PDF', False))
+
+    @patch('ftp_db_sync.subprocess.Popen')
+    @patch('ftp_db_sync.shutil.move')
+    @patch('ftp_db_sync.tempfile.mkdtemp', return_value='temp_files/convert_x')
+    @patch.object(Path, 'is_file', return_value=True)
+    @patch('ftp_db_sync.os.path.getsize', return_value=1024 * 1024)
+    def test_convert_document_ps2pdf_fail(self, mock_getsize, mock_is_file, mock_mkdtemp, mock_move, mock_popen):
+        mock_popen.return_value.wait.side_effect = [0, 1]
+        result = convert_document('temp_files/file.txt')
+        self.assertEqual(mock_popen.call_args_list, self.conversion_calls())
+        self.assertEqual(result.file_name, 'file.pdf')
+        self.assertEqual(result.path, 'temp_files/convert_x/lowriter_in.pdf')
+
+    @patch('ftp_db_sync.subprocess.Popen')
+    @patch('ftp_db_sync.shutil.move')
+    @patch('ftp_db_sync.tempfile.mkdtemp', return_value='temp_files/convert_x')
+    def test_convert_document_error(self, mock_mkdtemp, mock_move, mock_popen):
+        mock_popen.side_effect = OSError('not found')
+        result = convert_document('temp_files/file.txt')
+        self.assertEqual(mock_popen.call_count, 1)
+        self.assertEqual(result.file_name, 'file.txt')
+        self.assertEqual(result.path, 'temp_files/convert_x/lowriter_in.txt')
+        self.assertTrue(result.retry)
+        mock_popen.side_effect = None
+        mock_popen.return_value.wait.return_value = 77
+        self.assertEqual(convert_document('temp_files/file.txt')[5:], ('lowriter exited with status 77', False))
+        # killed by a signal
+        mock_popen.return_value.wait.return_value = -9
+        self.assertTrue(convert_document('temp_files/file.txt').retry)
+
+    @patch('ftp_db_sync.os.killpg')
+    @patch('ftp_db_sync.subprocess.Popen')
+    def test_run_command_timeout(self, mock_popen, mock_killpg):
+        mock_popen.return_value.pid = 123
+        mock_popen.return_value.wait.side_effect = [subprocess.TimeoutExpired('lowriter', 1), None]
+        self.assertIsNone(run_command(['lowriter'], 1))
+        mock_killpg.assert_called_with(123, signal.SIGKILL)
+
+    @patch('ftp_db_sync.uno', None)
+    def test_conversion_engine_office_needs_uno(self):
+        self.assertEqual(ConversionEngine(backend='office').backend, 'lowriter')
+
+    @patch.object(OfficeServer, 'store_pdf')
+    @patch.object(OfficeServer, 'stop')
+    @patch.object(OfficeServer, 'start')
+    def test_office_server_restarts(self, mock_start, mock_stop, mock_store):
+        office = OfficeServer(max_documents=2)
+
+        def start():
+            office.process = MagicMock()
+            office.process.poll.return_value = None
+            office.converted = 0
+        mock_start.side_effect = start
+        for _ in range(3):
+            self.assertTrue(office.convert('in.txt', 'out.pdf'))
+        self.assertEqual(mock_start.call_count, 2)
+        office.process.poll.return_value = -9
+        office.convert('in.txt', 'out.pdf')
+        self.assertEqual(mock_start.call_count, 3)
+
+    @patch.object(OfficeServer, 'store_pdf')
+    @patch.object(OfficeServer, 'start')
+    def test_office_server_conversion_error(self, mock_start, mock_store):
+        mock_store.side_effect = lambda source, dest, errors: errors.append(Exception('corrupt'))
+        office = OfficeServer()
+        office.process = MagicMock()
+        office.process.poll.return_value = None
+        self.assertIs(office.convert('in.txt', 'out.pdf'), False)
+        mock_start.assert_not_called()
+        # the listener crashed, the document may be fine
+        office.process.poll.return_value = -11
+        self.assertIsNone(office.convert('in.txt', 'out.pdf'))
+
+    def test_conversion_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = ConversionCache(directory=directory)
+            source = BytesIO(b'document')
+            key = cache.key('item1_1.doc', source)
+            self.assertEqual(key, cache.key('item1_2.doc', BytesIO(b'document')))
+            self.assertNotEqual(key, cache.key('item1_1.doc', BytesIO(b'other')))
+            self.assertEqual(cache.load(key, 'item1_1.doc', source), None)
+
+            pdf_path = os.path.join(directory, 'converted')
+            with open(pdf_path, 'wb') as pdf:
+                pdf.write(b'pdf')
+            cache.store(key, ConversionResult('item1_1.pdf', pdf_path, directory))
+            file_title, file_stream = cache.load(key, 'item1_2.doc', BytesIO(b'document'))
+            self.assertEqual(file_title, 'item1_2.pdf')
+            self.assertEqual(file_stream.read(), b'pdf')
+
+            failed_key = cache.key('item2_1.doc', BytesIO(b'broken'))
+            cache.store(failed_key, ConversionResult('item2_1.doc', pdf_path, directory))
+            original = BytesIO(b'broken')
+            self.assertEqual(cache.load(failed_key, 'item2_1.doc', original), ('item2_1.doc', original))
+            self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+    def test_conversion_cache_eviction(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = ConversionCache(directory=directory, max_bytes=5)
+            for name, age in [('old.pdf', 100), ('new.pdf', 10)]:
+                path = os.path.join(directory, name)
+                with open(path, 'wb') as pdf:
+                    pdf.write(b'abcd')
+                os.utime(path, (time.time() - age, time.time() - age))
+            cache.evict()
+            self.assertEqual(os.listdir(directory), ['new.pdf'])
+
+    @patch('ftp_db_sync.convert_document')
+    @patch.object(FileSync, 'store_stream_as_file')
+    def test_convert_entry_retries_interrupted_conversion(self, mock_store, mock_convert):
+        mock_convert.return_value = ConversionResult(
+            'file.doc', 'temp_files/convert_x/lowriter_in.doc', 'temp_files/convert_x',
+            failure='the converter did not finish', retry=True)
+        sync = FileSync(convert_workers=0)
+        sync.cache = MagicMock()
+        sync.cache.load.return_value = None
+        entry = VersionUpdate(file_id='1', file_name='file.doc', item_number='file')
+        self.assertIsNone(sync.convert_entry((entry, 'file.doc', BytesIO(b'document'))))
+        sync.cache.store.assert_not_called()
+        self.assertEqual(sync.failed_files, {'file.doc'})
+
+    @patch.object(FileSync, 'store_stream_as_file')
+    def test_convert_entry_cache_hit(self, mock_store):
+        sync = FileSync(convert_workers=0)
+        sync.cache = MagicMock()
+        sync.cache.load.return_value = 'file.pdf', BytesIO(b'cached')
+        entry = VersionUpdate(file_id='1', file_name='file.doc', item_number='file')
+        result = sync.convert_entry((entry, 'file.doc', BytesIO(b'document')))
+        self.assertEqual(result[1], 'file.pdf')
+        mock_store.assert_not_called()
 
     def test_file_description(self):
         file = NewFile(file_title='PHKIT_3 some file description.pdf', item_id='1', file_stream='')
@@ -232,11 +719,212 @@ class TestCase(unittest.TestCase):
 
     @patch('ftp_db_sync.FTP')
     def test_get_ftp_file_names(self, mock_ftp):
-        mock_ftp().__enter__().nlst.return_value = ['one', 'two', 'three.txt']
+        mock_ftp.return_value.mlsd.side_effect = error_perm('500 Unknown command')
+        mock_ftp.return_value.nlst.return_value = ['one', 'two', 'three.txt']
+        mock_ftp.return_value.size.return_value = 10
+        mock_ftp.return_value.sendcmd.return_value = '213 20180215120000'
         sync = FileSync()
         result = sync.get_ftp_file_names()
-        self.assertEqual(mock_ftp.call_count, 2)
+        self.assertEqual(mock_ftp.call_count, 1)
         self.assertEqual(list(result), ['three.txt'])
+        self.assertEqual(sync.ftp_entries[2], FtpEntry('three.txt', 10, '20180215120000'))
+        mock_ftp.return_value.sendcmd.assert_called_with('MDTM FTP/three.txt')
+
+    @patch('ftp_db_sync.FTP')
+    def test_get_ftp_file_names_newest_revision(self, mock_ftp):
+        mock_ftp.return_value.mlsd.return_value = [
+            ('item1_3.txt', {'type': 'file'}), ('item1_12.txt', {'type': 'file'}), ('item1_4.txt', {'type': 'file'})]
+        sync = FileSync()
+        sync.get_ftp_file_names()
+        self.assertEqual(sync.file_dict, {'item1': 'item1_12.txt'})
+
+    @patch('ftp_db_sync.FTP')
+    def test_get_ftp_file_names_mlsd(self, mock_ftp):
+        mock_ftp.return_value.mlsd.return_value = [
+            ('sub', {'type': 'dir'}),
+            ('item1_1.txt', {'type': 'file', 'size': '12', 'modify': '20180215120000'}),
+        ]
+        sync = FileSync()
+        self.assertEqual(list(sync.get_ftp_file_names()), ['item1'])
+        self.assertEqual(sync.ftp_entries, [FtpEntry('item1_1.txt', 12, '20180215120000')])
+        mock_ftp.return_value.nlst.assert_not_called()
+
+    def test_manifest_changed_files(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'manifest.json')
+            entries = [FtpEntry('item1_1.txt', 12, '1'), FtpEntry('item2_1.txt', 5, '1')]
+            FtpManifest(path).save(entries, failed={'item2_1.txt'})
+            manifest = FtpManifest(path)
+            self.assertEqual(manifest.changed(entries), {'item2_1.txt'})
+            self.assertEqual(manifest.changed([FtpEntry('item1_1.txt', 13, '2')]), {'item1_1.txt'})
+
+    def test_scheduler_order(self):
+        scheduler = WorkScheduler(prefixes=['urgent'])
+        stats = {'item1_2.pdf': (500, '1'), 'item2_1.pdf': (10, '1'), 'item3_1.pdf': (20, '1'),
+                 'urgent4_1.pdf': (900, '1'), 'item5_2.pdf': (10, '1')}
+        entries = [
+            NewUpload(2, 'item2_1.pdf', 'item2'), NewUpload(3, 'item3_1.pdf', 'item3'),
+            NewUpload(4, 'urgent4_1.pdf', 'urgent4'), NewUpload(6, 'item6_1.pdf', 'item6'),
+            VersionUpdate(1, 'item1_2.pdf', 'item1'), VersionUpdate(5, 'item5_2.pdf', 'item5'),
+        ]
+        self.assertEqual([entry.file_name for entry in scheduler.order(entries, stats)], [
+            'urgent4_1.pdf', 'item5_2.pdf', 'item1_2.pdf', 'item2_1.pdf', 'item3_1.pdf', 'item6_1.pdf'])
+        # files deferred by the last run keep their place
+        self.assertEqual([entry.file_name for entry in scheduler.order(entries, stats, ['item3_1.pdf'])], [
+            'urgent4_1.pdf', 'item5_2.pdf', 'item1_2.pdf', 'item3_1.pdf', 'item2_1.pdf', 'item6_1.pdf'])
+
+    @patch.object(FileSync, 'load_ftp_file')
+    def test_budget_defers_remaining_files(self, mock_load):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'manifest.json')
+            sync = FileSync(manifest_path=path, budget=0)
+            sync.scheduler.start()
+            self.assertIsNone(sync.download_entry(NewUpload(1, 'item1_1.pdf', 'item1')))
+            self.assertIsNone(sync.download_entry(NewUpload(2, 'item2_1.pdf', 'item2')))
+            mock_load.assert_not_called()
+            self.assertEqual(sync.deferred_files, {
+                'item1_1.pdf': 'run budget of 0s spent', 'item2_1.pdf': 'run budget of 0s spent'})
+            entries = [FtpEntry('item1_1.pdf', 3, '1'), FtpEntry('item2_1.pdf', 3, '1'), FtpEntry('item3_1.pdf', 3, '1')]
+            sync.manifest.save(entries, deferred=sync.deferred_files)
+            manifest = FtpManifest(path)
+            self.assertEqual(manifest.deferred, ['item1_1.pdf', 'item2_1.pdf'])
+            self.assertEqual(manifest.changed(entries), {'item1_1.pdf', 'item2_1.pdf'})
+
+    @patch.object(FileSync, 'sync_files')
+    @patch.object(FileSync, 'cleanup')
+    @patch('ftp_db_sync.FTP')
+    def test_sync_without_changes_skips_database(self, mock_ftp, mock_cleanup, mock_sync_files):
+        mock_ftp.return_value.mlsd.return_value = [
+            ('item1_1.txt', {'type': 'file', 'size': '12', 'modify': '20180215120000'})]
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'manifest.json')
+            FileSync(manifest_path=path).sync()
+            self.assertEqual(mock_sync_files.call_count, 1)
+            FileSync(manifest_path=path).sync()
+            self.assertEqual(mock_sync_files.call_count, 1)
+            FileSync(manifest_path=path, full_sync=True).sync()
+            self.assertEqual(mock_sync_files.call_count, 2)
+
+    def test_journal_resumes_interrupted_run(self):
+        stats = {'item1_2.txt': (3, '1'), 'item2_2.pdf': (3, '1')}
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'journal.sqlite')
+            sync = FileSync(journal_path=path)
+            sync.ftp_stats = dict(stats)
+
+            def load(file_name):
+                stream = sync.journal.download_stream(file_name)
+                stream.write(b'abc')
+                stream.seek(0)
+                return stream
+            with patch.object(FileSync, 'load_ftp_file', side_effect=load):
+                sync.download_entry(NewUpload(1, 'item1_2.txt', 'item1'))[2].close()
+                sync.download_entry(NewUpload(2, 'item2_2.pdf', 'item2'))[2].close()
+            sync.journal.written([('item2_2.pdf', stats['item2_2.pdf'], 'item2_2.pdf', 7)])
+            sync.journal.close()
+
+            resumed = FileSync(journal_path=path)
+            resumed.ftp_stats = dict(stats)
+            with patch.object(FileSync, 'load_ftp_file', return_value=BytesIO(b'new')) as mock_load:
+                entry, file_name, stream = resumed.download_entry(NewUpload(1, 'item1_2.txt', 'item1'))
+                self.assertIsNone(resumed.download_entry(NewUpload(2, 'item2_2.pdf', 'item2')))
+                self.assertEqual(mock_load.call_count, 0)
+                # changed on FTP since the interrupted run
+                resumed.ftp_stats['item1_2.txt'] = (4, '2')
+                resumed.download_entry(NewUpload(1, 'item1_2.txt', 'item1'))
+                self.assertEqual(mock_load.call_count, 1)
+            self.assertEqual((file_name, stream.read()), ('item1_2.txt', b'abc'))
+            stream.close()
+            resumed.journal.clear()
+            self.assertFalse(os.path.exists(os.path.join(directory, 'journal_files')))
+            resumed.journal.close()
+
+    def test_shard_of_is_stable(self):
+        self.assertEqual([shard_of(item, 4) for item in ['item1', 'item2', 'item3', 'item4']], [1, 3, 1, 2])
+
+    @patch.object(ShardCoordinator, 'release')
+    @patch.object(ShardCoordinator, 'finish')
+    @patch.object(ShardCoordinator, 'claim')
+    @patch.object(FileSync, 'sync_files')
+    def test_sync_shards(self, mock_sync_files, mock_claim, mock_finish, mock_release):
+        sync = FileSync(shards=4, shard=1)
+        sync.file_dict = {item: item + '_1.pdf' for item in ['item1', 'item2', 'item4', 'item7']}
+        synced = []
+        mock_sync_files.side_effect = lambda: synced.append(sorted(sync.file_dict))
+        # shards 3 and 0 are held by live workers, shard 2 was abandoned
+        mock_claim.side_effect = lambda shard, own=False: shard in (1, 2)
+        sync.sync_shards()
+        self.assertEqual(mock_claim.call_args_list, [
+            call(1, own=True), call(2, own=False), call(3, own=False), call(0, own=False)])
+        self.assertEqual(synced, [['item1'], ['item4']])
+        self.assertEqual(mock_finish.call_args_list, [call(1), call(2)])
+        self.assertEqual(mock_release.call_count, 2)
+        self.assertEqual(sync.deferred_files, {
+            'item2_1.pdf': 'shard 3 is held by another worker', 'item7_1.pdf': 'shard 0 is held by another worker'})
+
+    @patch.object(FileSync, 'close')
+    @patch.object(FileSync, 'sync')
+    def test_daemon_retries_failed_cycles(self, mock_sync, mock_close):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'status.json')
+            sync = FileSync(status_path=path)
+            results = [ValueError('database down'), None, None]
+
+            def cycle():
+                result = results.pop(0)
+                if not results:
+                    sync.stop()
+                if result is not None:
+                    raise result
+            mock_sync.side_effect = cycle
+            with patch.object(sync.stopping, 'wait') as mock_wait:
+                sync.run_daemon(interval=60, jitter=0)
+            self.assertEqual(mock_sync.call_count, 3)
+            self.assertEqual(mock_wait.call_args_list, [call(30), call(60), call(60)])
+            mock_close.assert_called_once_with()
+            with open(path) as status:
+                state = json.load(status)
+        self.assertEqual((state['state'], state['cycles'], state['last_error']), ('stopped', 3, None))
+
+    def test_daemon_backoff(self):
+        sync = FileSync()
+        self.assertEqual([sync.next_delay(failures) for failures in range(1, 4)], [30, 60, 120])
+        self.assertEqual(sync.next_delay(20), 3600)
+        self.assertTrue(270 <= sync.next_delay(0, interval=300, jitter=0.1) <= 330)
+
+    @patch('ftp_db_sync.FTP')
+    def test_ftp_session_reused(self, mock_ftp):
+        mock_ftp.return_value.nlst.return_value = ['item1_1.txt']
+        sync = FileSync()
+        sync.get_ftp_file_names()
+        sync.load_ftp_file('item1_1.txt')
+        sync.load_ftp_file('item1_1.txt')
+        self.assertEqual(mock_ftp.call_count, 1)
+        self.assertEqual(mock_ftp.return_value.retrbinary.call_count, 2)
+
+    @patch('ftp_db_sync.FTP')
+    def test_ftp_session_reconnect_on_421(self, mock_ftp):
+        broken, fresh = MagicMock(), MagicMock()
+        broken.nlst.side_effect = error_temp('421 Timeout')
+        fresh.nlst.return_value = ['item1_1.txt']
+        mock_ftp.side_effect = [broken, fresh]
+        pool = FTPSessionPool()
+        self.assertEqual(pool.run(lambda ftp: ftp.nlst('FTP')), ['item1_1.txt'])
+        broken.close.assert_called_with()
+        pool.close()
+        fresh.quit.assert_called_with()
+
+    @patch('ftp_db_sync.FTP')
+    def test_ftp_session_keepalive(self, mock_ftp):
+        stale, fresh = MagicMock(), MagicMock()
+        stale.voidcmd.side_effect = EOFError()
+        mock_ftp.side_effect = [stale, fresh]
+        pool = FTPSessionPool(keepalive=0)
+        with pool.session() as ftp:
+            self.assertIs(ftp, stale)
+        with pool.session() as ftp:
+            self.assertIs(ftp, fresh)
+        stale.voidcmd.assert_called_with('NOOP')
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file